@@ -89,8 +89,6 @@ pgd_attack = attacks.LinfPGDAttack(model=attgan.G, device=torch.device('cuda' if
 for idx, (img_a, att_a) in enumerate(test_dataloader):
     if args.num_test is not None and idx == args.num_test:
         break
-    print(idx, img_a)
-    break
     img_a = img_a.cuda() if args.gpu else img_a
     att_a = att_a.cuda() if args.gpu else att_a
     att_a = att_a.type(torch.float)
@@ -103,15 +101,18 @@ for idx, (img_a, att_a) in enumerate(test_dataloader):
         att_b_list.append(tmp)
     
     
+    att_b__list = []
     for i, att_b in enumerate(att_b_list):
         att_b_ = (att_b * 2 - 1) * args.thres_int
         if i > 0:
             att_b_[..., i - 1] = att_b_[..., i - 1] * args.test_int / args.thres_int
-        with torch.no_grad():
-            gen_noattack = attgan.G(img_a, att_b_)
-        # print(img_a.shape, gen_noattack.shape) # debug
-        # Attacks
-        x_adv, perturb = pgd_attack.universal_perturb(img_a, att_b_,gen_noattack, attgan)
+        att_b__list.append(att_b_)
+    with torch.no_grad():
+        # Encode once, decode all attribute vectors as one batch
+        zs = [z.repeat(len(att_b__list), 1, 1, 1) for z in attgan.G(img_a, mode='enc')]
+        gen_noattack = attgan.G(zs, torch.cat(att_b__list), mode='dec')
+    # Attacks
+    x_adv, perturb = pgd_attack.universal_perturb_multi(img_a, att_b__list, list(gen_noattack.split(img_a.size(0))), attgan)
     print(idx)
     if idx==100:
         break
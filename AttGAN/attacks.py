@@ -1,4 +1,6 @@
 import copy
+import os
+import sys
 import numpy as np
 from collections import Iterable
 from scipy.stats import truncnorm
@@ -11,13 +13,23 @@ try:
 except:
     import AttGAN.defenses.smoothing as smoothing
 
+try:
+    from attack_utils import AMP_DTYPES, amp_autocast, LossScaler, input_grad, frozen_model, clip_tensor, clip_tensor_
+except ImportError:
+    # Run from AttGAN/: the helpers shared with the StarGAN attacks live at the repository root
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from attack_utils import AMP_DTYPES, amp_autocast, LossScaler, input_grad, frozen_model, clip_tensor, clip_tensor_
+
 class LinfPGDAttack(object):
-    def __init__(self, model=None, device=None, epsilon=0.05, k=10, a=0.01, feat = None):
+    def __init__(self, model=None, device=None, epsilon=0.05, k=10, a=0.01, feat = None, amp=None, checkpoint=None):
         """
         FGSM, I-FGSM and PGD attacks
         epsilon: magnitude of attack
         k: iterations
         a: step size
+        amp: None (fp32), 'bf16' or 'fp16' mixed precision for the generator forward/backward
+        checkpoint: gradient checkpointing of the generator blocks during the attack, True/False
+            (None keeps the model's setting), trading one extra forward for activation memory
         """
         self.model = model
         self.epsilon = epsilon
@@ -34,7 +46,15 @@ class LinfPGDAttack(object):
 
         # Universal perturbation
         self.up = None
-        
+
+        # Mixed precision, fp16 gradients go through a dynamic loss scaler
+        self.amp = amp
+        self.scaler = LossScaler() if amp == 'fp16' else None
+
+        self.checkpoint = checkpoint
+
+    def _autocast(self):
+        return amp_autocast(self.device, self.amp)
 
     def perturb(self, X_nat, y, c_trg):
         """
@@ -47,25 +67,23 @@ class LinfPGDAttack(object):
             # use the following if FGSM or I-FGSM and random seeds are fixed
             # X = X_nat.clone().detach_() + torch.tensor(np.random.uniform(-0.001, 0.001, X_nat.shape).astype('float32')).cuda()    
 
-        for i in range(self.k):
-            X.requires_grad = True
-            output, feats = self.model(X, c_trg)
+        with frozen_model(self.model, self.checkpoint):
+            for i in range(self.k):
+                X.requires_grad = True
+                with self._autocast():
+                    output, feats = self.model(X, c_trg)
 
-            if self.feat:
-                output = feats[self.feat]
+                    if self.feat:
+                        output = feats[self.feat]
 
-            self.model.zero_grad()
-            # Minus in the loss means "towards" and plus means "away from"
-            loss = self.loss_fn(output, y)
-            loss.backward()
-            grad = X.grad
+                    # Minus in the loss means "towards" and plus means "away from"
+                    loss = self.loss_fn(output, y)
+                grad = input_grad(loss, X, self.scaler)
 
-            X_adv = X + self.a * grad.sign()
+                X_adv = X + self.a * grad.sign()
 
-            eta = torch.clamp(X_adv - X_nat, min=-self.epsilon, max=self.epsilon)
-            X = torch.clamp(X_nat + eta, min=-1, max=1).detach_()
-
-        self.model.zero_grad()
+                eta = clip_tensor(X_adv - X_nat, -self.epsilon, self.epsilon)
+                X = clip_tensor(X_nat + eta, -1, 1).detach_()
 
         return X, X - X_nat
 
@@ -80,28 +98,62 @@ class LinfPGDAttack(object):
             # use the following if FGSM or I-FGSM and random seeds are fixed
             # X = X_nat.clone().detach_() + torch.tensor(np.random.uniform(-0.001, 0.001, X_nat.shape).astype('float32')).cuda()    
 
-        for i in range(self.k):
-            X.requires_grad = True
-            output = attgan.G(X, X_att)
+        with frozen_model(attgan.G, self.checkpoint):
+            for i in range(self.k):
+                X.requires_grad = True
+                with self._autocast():
+                    output = attgan.G(X, X_att)
 
-            attgan.G.zero_grad()
-            # Minus in the loss means "towards" and plus means "away from"
-            loss = self.loss_fn(output, y)
-            loss.backward()
-            grad = X.grad
+                    # Minus in the loss means "towards" and plus means "away from"
+                    loss = self.loss_fn(output, y)
+                grad = input_grad(loss, X, self.scaler)
 
-            X_adv = X + self.a * grad.sign()
+                X_adv = X + self.a * grad.sign()
 
-            if self.up is None:
-                eta = torch.clamp(X_adv - X_nat, min=-self.epsilon, max=self.epsilon).detach_()
-                self.up = eta
-            else:
-                eta = torch.clamp(X_adv - X_nat, min=-self.epsilon, max=self.epsilon).detach_()
-                self.up = self.up * 0.9 + eta * 0.1
-            X = torch.clamp(X_nat + self.up, min=-1, max=1).detach_()
+                if self.up is None:
+                    eta = clip_tensor(X_adv - X_nat, -self.epsilon, self.epsilon).detach_()
+                    self.up = eta
+                else:
+                    eta = clip_tensor(X_adv - X_nat, -self.epsilon, self.epsilon).detach_()
+                    self.up = self.up * 0.9 + eta * 0.1
+                X = clip_tensor(X_nat + self.up, -1, 1).detach_()
 
-        attgan.G.zero_grad()
-        
+        return X, X - X_nat
+
+    def universal_perturb_multi(self, X_nat, X_att_list, y_list, attgan):
+        """
+        Universal attack against all attribute vectors at once.
+        Each step encodes the image once, decodes every attribute vector as one batch
+        from the shared encoder features, and backpropagates the summed loss once.
+        """
+        N = len(X_att_list)
+        X_att = torch.cat(X_att_list, dim=0)
+        y = torch.cat(y_list, dim=0)
+
+        X = X_nat.clone().detach_() + torch.tensor(np.random.uniform(-self.epsilon, self.epsilon, X_nat.shape).astype('float32')).to(self.device) if self.rand else X_nat.clone().detach_()
+
+        with frozen_model(attgan.G, self.checkpoint):
+            for i in range(self.k):
+                X.requires_grad = True
+                with self._autocast():
+                    zs = attgan.G(X, mode='enc')
+                    # Broadcast the encoder features to every attribute vector
+                    zs = [z.repeat(N, 1, 1, 1) for z in zs]
+                    output = attgan.G(zs, X_att, mode='dec')
+
+                    # Sum of the per-attribute losses, the mean over the stacked batch divides by N
+                    loss = N * self.loss_fn(output, y)
+                grad = input_grad(loss, X, self.scaler)
+
+                X_adv = X + self.a * grad.sign()
+
+                # One perturbation for the whole batch
+                eta = clip_tensor(X_adv - X_nat, -self.epsilon, self.epsilon).detach_().mean(dim=0, keepdim=True)
+                if self.up is None:
+                    self.up = eta
+                else:
+                    self.up = self.up * 0.9 + eta * 0.1
+                X = clip_tensor(X_nat + self.up, -1, 1).detach_()
 
         return X, X - X_nat
 
@@ -129,21 +181,19 @@ class LinfPGDAttack(object):
         # blurred_image = smoothing.AverageSmoothing2D(channels=3, kernel_size=ks).to(self.device)(X_orig)
         blurred_image = smoothing.GaussianSmoothing2D(sigma=sig, channels=3, kernel_size=ks).to(self.device)(X_orig)
 
-        for i in range(self.k):
-            X.requires_grad = True
-            output, feats = self.model.forward_blur(X, c_trg, preproc)
+        with frozen_model(self.model, self.checkpoint):
+            for i in range(self.k):
+                X.requires_grad = True
+                with self._autocast():
+                    output, feats = self.model.forward_blur(X, c_trg, preproc)
 
-            self.model.zero_grad()
-            loss = self.loss_fn(output, y)
-            loss.backward()
-            grad = X.grad
+                    loss = self.loss_fn(output, y)
+                grad = input_grad(loss, X, self.scaler)
 
-            X_adv = X + self.a * grad.sign()
+                X_adv = X + self.a * grad.sign()
 
-            eta = torch.clamp(X_adv - X_nat, min=-self.epsilon, max=self.epsilon)
-            X = torch.clamp(X_nat + eta, min=-1, max=1).detach_()
-
-        self.model.zero_grad()
+                eta = clip_tensor(X_adv - X_nat, -self.epsilon, self.epsilon)
+                X = clip_tensor(X_nat + eta, -1, 1).detach_()
 
         return X, X - X_nat, blurred_image
 
@@ -167,42 +217,40 @@ class LinfPGDAttack(object):
         # Type of blur
         blur_type = 1
 
-        for i in range(self.k):
-            # Declare smoothing layer
-            if blur_type == 1:
-                preproc = smoothing.GaussianSmoothing2D(sigma=sig, channels=3, kernel_size=ks_gauss).to(self.device)
-            elif blur_type == 2:
-                preproc = smoothing.AverageSmoothing2D(channels=3, kernel_size=ks_avg).to(self.device)
-
-            X.requires_grad = True
-            output, feats = self.model.forward_blur(X, c_trg, preproc)
+        with frozen_model(self.model, self.checkpoint):
+            for i in range(self.k):
+                # Declare smoothing layer
+                if blur_type == 1:
+                    preproc = smoothing.GaussianSmoothing2D(sigma=sig, channels=3, kernel_size=ks_gauss).to(self.device)
+                elif blur_type == 2:
+                    preproc = smoothing.AverageSmoothing2D(channels=3, kernel_size=ks_avg).to(self.device)
 
-            if self.feat:
-                output = feats[self.feat]
+                X.requires_grad = True
+                with self._autocast():
+                    output, feats = self.model.forward_blur(X, c_trg, preproc)
 
-            self.model.zero_grad()
-            loss = self.loss_fn(output, y)
-            loss.backward()
-            grad = X.grad
+                    if self.feat:
+                        output = feats[self.feat]
 
-            X_adv = X + self.a * grad.sign()
+                    loss = self.loss_fn(output, y)
+                grad = input_grad(loss, X, self.scaler)
 
-            eta = torch.clamp(X_adv - X_nat, min=-self.epsilon, max=self.epsilon)
-            X = torch.clamp(X_nat + eta, min=-1, max=1).detach_()
+                X_adv = X + self.a * grad.sign()
 
-            # Iterate through blur types
-            if blur_type == 1:
-                sig += 0.5
-                if sig >= 3.2:
-                    blur_type = 2
-                    sig = 1
-            if blur_type == 2:
-                ks_avg += 2
-                if ks_avg >= 11:
-                    blur_type = 1
-                    ks_avg = 3
+                eta = clip_tensor(X_adv - X_nat, -self.epsilon, self.epsilon)
+                X = clip_tensor(X_nat + eta, -1, 1).detach_()
 
-        self.model.zero_grad()
+                # Iterate through blur types
+                if blur_type == 1:
+                    sig += 0.5
+                    if sig >= 3.2:
+                        blur_type = 2
+                        sig = 1
+                if blur_type == 2:
+                    ks_avg += 2
+                    if ks_avg >= 11:
+                        blur_type = 1
+                        ks_avg = 3
 
         return X, X - X_nat
 
@@ -226,44 +274,42 @@ class LinfPGDAttack(object):
         # Type of blur
         blur_type = 1
 
-        for i in range(self.k):
-            full_loss = 0.0
-            X.requires_grad = True
-            self.model.zero_grad()
+        with frozen_model(self.model, self.checkpoint):
+            for i in range(self.k):
+                full_loss = 0.0
+                X.requires_grad = True
+                with self._autocast():
 
-            for j in range(9):  # 9 types of blur
-                # Declare smoothing layer
-                if blur_type == 1:
-                    preproc = smoothing.GaussianSmoothing2D(sigma=sig, channels=3, kernel_size=ks_gauss).to(self.device)
-                elif blur_type == 2:
-                    preproc = smoothing.AverageSmoothing2D(channels=3, kernel_size=ks_avg).to(self.device)
+                    for j in range(9):  # 9 types of blur
+                        # Declare smoothing layer
+                        if blur_type == 1:
+                            preproc = smoothing.GaussianSmoothing2D(sigma=sig, channels=3, kernel_size=ks_gauss).to(self.device)
+                        elif blur_type == 2:
+                            preproc = smoothing.AverageSmoothing2D(channels=3, kernel_size=ks_avg).to(self.device)
 
             
-                output, feats = self.model.forward_blur(X, c_trg, preproc)
+                        output, feats = self.model.forward_blur(X, c_trg, preproc)
             
-                loss = self.loss_fn(output, y)
-                full_loss += loss
+                        loss = self.loss_fn(output, y)
+                        full_loss += loss
 
-                if blur_type == 1:
-                    sig += 0.5
-                    if sig >= 3.2:
-                        blur_type = 2
-                        sig = 1
-                if blur_type == 2:
-                    ks_avg += 2
-                    if ks_avg >= 11:
-                        blur_type = 1
-                        ks_avg = 3
-                
-            full_loss.backward()
-            grad = X.grad
+                        if blur_type == 1:
+                            sig += 0.5
+                            if sig >= 3.2:
+                                blur_type = 2
+                                sig = 1
+                        if blur_type == 2:
+                            ks_avg += 2
+                            if ks_avg >= 11:
+                                blur_type = 1
+                                ks_avg = 3
 
-            X_adv = X + self.a * grad.sign()
+                grad = input_grad(full_loss, X, self.scaler)
 
-            eta = torch.clamp(X_adv - X_nat, min=-self.epsilon, max=self.epsilon)
-            X = torch.clamp(X_nat + eta, min=-1, max=1).detach_()
+                X_adv = X + self.a * grad.sign()
 
-        self.model.zero_grad()
+                eta = clip_tensor(X_adv - X_nat, -self.epsilon, self.epsilon)
+                X = clip_tensor(X_nat + eta, -1, 1).detach_()
 
         return X, X - X_nat
 
@@ -282,24 +328,23 @@ class LinfPGDAttack(object):
         j = 0
         J = len(c_trg)
 
-        for i in range(self.k):
-            X.requires_grad = True
-            output, feats = self.model(X, c_trg[j])
+        with frozen_model(self.model, self.checkpoint):
+            for i in range(self.k):
+                X.requires_grad = True
+                with self._autocast():
+                    output, feats = self.model(X, c_trg[j])
 
-            self.model.zero_grad()
+                    loss = self.loss_fn(output, y)
+                grad = input_grad(loss, X, self.scaler)
 
-            loss = self.loss_fn(output, y)
-            loss.backward()
-            grad = X.grad
+                X_adv = X + self.a * grad.sign()
 
-            X_adv = X + self.a * grad.sign()
+                eta = clip_tensor(X_adv - X_nat, -self.epsilon, self.epsilon)
+                X = clip_tensor(X_nat + eta, -1, 1).detach_()
 
-            eta = torch.clamp(X_adv - X_nat, min=-self.epsilon, max=self.epsilon)
-            X = torch.clamp(X_nat + eta, min=-1, max=1).detach_()
-
-            j += 1
-            if j == J:
-                j = 0
+                j += 1
+                if j == J:
+                    j = 0
 
         return X, eta
 
@@ -316,44 +361,31 @@ class LinfPGDAttack(object):
 
         J = len(c_trg)
         
-        for i in range(self.k):
-            full_loss = 0.0
-            X.requires_grad = True
-            self.model.zero_grad()
+        with frozen_model(self.model, self.checkpoint):
+            for i in range(self.k):
+                full_loss = 0.0
+                X.requires_grad = True
+                with self._autocast():
 
-            for j in range(J):
-                output, feats = self.model(X, c_trg[j])
+                    for j in range(J):
+                        output, feats = self.model(X, c_trg[j])
 
-                loss = self.loss_fn(output, y)
-                full_loss += loss
+                        loss = self.loss_fn(output, y)
+                        full_loss += loss
 
-            full_loss.backward()
-            grad = X.grad
+                grad = input_grad(full_loss, X, self.scaler)
 
-            X_adv = X + self.a * grad.sign()
+                X_adv = X + self.a * grad.sign()
 
-            eta = torch.clamp(X_adv - X_nat, min=-self.epsilon, max=self.epsilon)
-            X = torch.clamp(X_nat + eta, min=-1, max=1).detach_()
+                eta = clip_tensor(X_adv - X_nat, -self.epsilon, self.epsilon)
+                X = clip_tensor(X_nat + eta, -1, 1).detach_()
 
         return X, eta
 
-def clip_tensor(X, Y, Z):
-    # Clip X with Y min and Z max
-    X_np = X.data.cpu().numpy()
-    Y_np = Y.data.cpu().numpy()
-    Z_np = Z.data.cpu().numpy()
-    X_clipped = np.clip(X_np, Y_np, Z_np)
-    X_res = torch.FloatTensor(X_clipped)
-    return X_res
-
 def perturb_batch(X, y, c_trg, model, adversary):
     # Perturb batch function for adversarial training
-    model_cp = copy.deepcopy(model)
-    for p in model_cp.parameters():
-        p.requires_grad = False
-    model_cp.eval()
-    
-    adversary.model = model_cp
+    # The attack runs inside frozen_model(), so the live model can be used without a copy
+    adversary.model = model
 
     X_adv, _ = adversary.perturb(X, y, c_trg)
 
@@ -7,6 +7,7 @@
 
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 try:
     from nn import LinearBlock, Conv2dBlock, ConvTranspose2dBlock
 except:
@@ -53,12 +54,22 @@ class Generator(nn.Module):
                     n_in, 3, (4, 4), stride=2, padding=1, norm_fn='none', acti_fn='tanh'
                 )]
         self.dec_layers = nn.ModuleList(layers)
+
+        # Gradient checkpointing of every encoder/decoder block
+        self.checkpoint_blocks = False
+    
+    def _block(self, layer, z):
+        # Only the block outputs are kept for backward (they are needed for the shortcuts anyway),
+        # the norm/activation intermediates are recomputed
+        if self.checkpoint_blocks and torch.is_grad_enabled():
+            return checkpoint(layer, z, use_reentrant=False)
+        return layer(z)
     
     def encode(self, x):
         z = x
         zs = []
         for layer in self.enc_layers:
-            z = layer(z)
+            z = self._block(layer, z)
             zs.append(z)
         return zs
     
@@ -66,7 +77,7 @@ class Generator(nn.Module):
         a_tile = a.view(a.size(0), -1, 1, 1).repeat(1, 1, self.f_size, self.f_size)
         z = torch.cat([zs[-1], a_tile], dim=1)
         for i, layer in enumerate(self.dec_layers):
-            z = layer(z)
+            z = self._block(layer, z)
             if self.shortcut_layers > i:  # Concat 1024 with 512
                 z = torch.cat([z, zs[len(self.dec_layers) - 2 - i]], dim=1)
             if self.inject_layers > i:
@@ -14,22 +14,40 @@ class DiffJPEG(nn.Module):
             width(int): Original image width
             differentiable(bool): If true uses custom differentiable
                 rounding function, if false uses standrard torch.round
-            quality(float): Quality factor for jpeg compression scheme. 
+            quality(float or tensor): Quality factor for jpeg compression
+                scheme, or one quality per sample of the batch.
         '''
         super(DiffJPEG, self).__init__()
         if differentiable:
-            rounding = diff_round
+            self.rounding = diff_round
         else:
-            rounding = torch.round
+            self.rounding = torch.round
+        self.compress = compress_jpeg()
+        self.decompress = decompress_jpeg(height, width)
+        self.set_quality(quality)
+
+    def set_quality(self, quality):
+        ''' Change the compression quality
+        Inputs:
+            quality(float or tensor): one quality for the whole batch, or a
+                tensor holding one quality per sample
+        '''
         factor = quality_to_factor(quality)
-        self.compress = compress_jpeg(rounding=rounding, factor=factor)
-        self.decompress = decompress_jpeg(height, width, rounding=rounding,
-                                          factor=factor)
+        if torch.is_tensor(factor):
+            # broadcast against batch x blocks x 8 x 8 coefficients
+            factor = factor.view(-1, 1, 1, 1)
+        for layer in (self.compress.y_quantize, self.compress.c_quantize,
+                      self.decompress.y_dequantize, self.decompress.c_dequantize):
+            layer.factor = factor
 
     def forward(self, x):
         '''
-
+        Inputs:
+            x(tensor): batch x 3 x height x width, in [0, 1]
+        Output:
+            recovered(tensor): the image after a JPEG round trip
         '''
         y, cb, cr = self.compress(x)
+        y, cb, cr = self.rounding(y), self.rounding(cb), self.rounding(cr)
         recovered = self.decompress(y, cb, cr)
         return recovered
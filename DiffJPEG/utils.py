@@ -34,10 +34,13 @@ def diff_round(x):
 def quality_to_factor(quality):
     """ Calculate factor corresponding to quality
     Input:
-        quality(float): Quality for jpeg compression
+        quality(float or tensor): Quality for jpeg compression
     Output:
-        factor(float): Compression factor
+        factor(float or tensor): Compression factor
     """
+    if torch.is_tensor(quality):
+        quality = quality.float()
+        return torch.where(quality < 50, 5000. / quality, 200. - quality*2) / 100.
     if quality < 50:
         quality = 5000. / quality
     else:
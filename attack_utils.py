@@ -0,0 +1,132 @@
+"""Attack helpers shared by the StarGAN (stargan/attacks.py) and AttGAN (AttGAN/attacks.py) attacks."""
+
+from contextlib import contextmanager
+
+import torch
+import torch.nn as nn
+
+# Mixed-precision modes: autocast dtype of the generator forward pass
+AMP_DTYPES = {
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16,
+}
+
+def amp_autocast(device, amp=None):
+    """
+    Autocast context for the generator forward pass (and its loss); a no-op when amp is None.
+    bf16 runs on CPU and recent GPUs, fp16 is meant for GPUs and needs a LossScaler.
+    The perturbation, the step and the projection stay in fp32 outside this context.
+    """
+    device_type = torch.device(device).type if device is not None else 'cpu'
+    if amp is None:
+        return torch.autocast(device_type, enabled=False)
+    return torch.autocast(device_type, dtype=AMP_DTYPES[amp])
+
+class LossScaler(object):
+    def __init__(self, init_scale=2.**16, growth_factor=2.0, backoff_factor=0.5, growth_interval=100):
+        """
+        Dynamic loss scaling for fp16 attacks.
+        The loss is scaled up before the backward pass so that small gradients do not
+        flush to zero in half precision. When the input gradient overflows, the step gets
+        no gradient and the scale backs off; after growth_interval clean steps it grows.
+        """
+        self.scale = init_scale
+        self.growth_factor = growth_factor
+        self.backoff_factor = backoff_factor
+        self.growth_interval = growth_interval
+        self.good_steps = 0
+
+    def grad(self, loss, X):
+        grad, = torch.autograd.grad(loss * self.scale, X)
+        if not torch.isfinite(grad).all():
+            self.scale *= self.backoff_factor
+            self.good_steps = 0
+            return torch.zeros_like(grad)
+
+        self.good_steps += 1
+        if self.good_steps % self.growth_interval == 0:
+            self.scale *= self.growth_factor
+        return grad.div_(self.scale)
+
+def input_grad(loss, X, scaler=None):
+    """
+    d(loss)/dX, through the loss scaler when one is given.
+    """
+    if scaler is None:
+        grad, = torch.autograd.grad(loss, X)
+        return grad
+    return scaler.grad(loss, X)
+
+@contextmanager
+def frozen_model(model, checkpoint=None):
+    """
+    Attack execution context, shared by the StarGAN and AttGAN attacks.
+    Parameters stop requiring grad, so backward only produces d(loss)/dX, and the
+    model runs as at test time: BatchNorm/Dropout switch to eval and normalize with
+    the statistics of training, while InstanceNorm keeps using instance statistics
+    (as StarGAN does) with any running buffers set aside, so they are neither
+    updated nor in the way of torch.func transforms.
+    checkpoint: gradient checkpointing of the generator, when it supports it (None keeps
+        its setting): a number of segments for StarGAN's Generator.checkpoint_segments,
+        a flag for AttGAN's Generator.checkpoint_blocks.
+    Everything is restored on exit.
+    """
+    requires_grad = [(p, p.requires_grad) for p in model.parameters()]
+    training = [(m, m.training) for m in model.modules()]
+    buffers = []
+
+    # Generators with gradient checkpointing support
+    segments = getattr(model, 'checkpoint_segments', None)
+    blocks = getattr(model, 'checkpoint_blocks', None)
+    if checkpoint is not None and segments is not None:
+        model.checkpoint_segments = checkpoint
+    if checkpoint is not None and blocks is not None:
+        model.checkpoint_blocks = bool(checkpoint)
+
+    for p, _ in requires_grad:
+        p.requires_grad_(False)
+    model.eval()
+    for m, was_training in training:
+        if isinstance(m, nn.modules.instancenorm._InstanceNorm) and was_training:
+            m.train()
+            if m.track_running_stats:
+                buffers.append((m, m.running_mean, m.running_var))
+                m.running_mean, m.running_var = None, None
+                m.track_running_stats = False
+
+    try:
+        yield model
+    finally:
+        if segments is not None:
+            model.checkpoint_segments = segments
+        if blocks is not None:
+            model.checkpoint_blocks = blocks
+        for m, running_mean, running_var in buffers:
+            m.running_mean, m.running_var = running_mean, running_var
+            m.track_running_stats = True
+        for m, was_training in training:
+            m.training = was_training
+        for p, flag in requires_grad:
+            p.requires_grad_(flag)
+
+def clip_tensor(X, Y, Z):
+    """
+    Clip X with Y min and Z max, elementwise and on X's device.
+    Y and Z are tensors broadcastable to X (e.g. one bound per sample) or numbers.
+    Like the NumPy version it replaces, the result is a new, detached tensor.
+    """
+    return clip_tensor_(X.detach().clone(), Y, Z)
+
+def clip_tensor_(X, Y, Z):
+    """
+    In-place clip_tensor, X keeps its storage, dtype and device.
+    """
+    if torch.is_tensor(Y):
+        torch.max(X, Y, out=X)
+    else:
+        X.clamp_(min=Y)
+    if torch.is_tensor(Z):
+        torch.min(X, Z, out=X)
+    else:
+        X.clamp_(max=Z)
+    return X
@@ -0,0 +1,225 @@
+import argparse
+import json
+import os
+import queue
+import traceback
+from collections import deque, namedtuple
+from os.path import join
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from torchvision.utils import save_image
+
+from data import CelebA
+from stargan.model import Generator
+import stargan.attacks as attacks
+from universal import create_labels, load_model_weights
+
+
+# One unit of work: attack dataset[index] towards target domain `target` with `method`
+Job = namedtuple('Job', ['job_id', 'index', 'target', 'method'])
+
+
+def parse(args=None):
+    """ load config from the setting.json, plus the scheduler options """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--setting', type=str, default='./setting.json')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--method', type=str, default='raw', help="'raw' or one of attacks.ATTACK_METHODS")
+    parser.add_argument('--mode', type=str, default='test', help='CelebA split to protect')
+    parser.add_argument('--retries', type=int, default=2, help='attempts per job after the first failure')
+    parser.add_argument('--queue_size', type=int, default=None, help='jobs in flight, 2 per worker by default')
+    parser.add_argument('--resume_iters', type=int, default=200000, help='StarGAN checkpoint to attack')
+    parser.add_argument('--output', type=str, default=None, help='defaults to global_settings.results_path')
+    parser.add_argument('--budget', type=float, default=None,
+                        help='seconds per job, the attack stops early instead of running all its iterations')
+    args = parser.parse_args(args)
+    with open(args.setting, 'r') as f:
+        args_attack = json.load(f, object_hook=lambda d: argparse.Namespace(**d))
+    return args, args_attack
+
+
+def make_jobs(num_images, num_targets, method):
+    """Image-major job list, the order results are written in."""
+    jobs = []
+    for index in range(num_images):
+        for target in range(num_targets):
+            jobs.append(Job(len(jobs), index, target, method))
+    return jobs
+
+
+class StarGANWorker(object):
+    def __init__(self, args, args_attack, seed=0):
+        """
+        State of one worker process: its own generator, dataset and attacks (RobustJPEGAttack
+        holds its own DiffJPEG modules), built once and reused by every job it runs.
+        Calling it with a Job returns the protected image in [0, 1].
+        """
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+
+        self.device = torch.device('cpu')
+        self.args_attack = args_attack
+        self.config = args_attack.stargan
+        self.G = Generator(self.config.g_conv_dim, self.config.c_dim, self.config.g_repeat_num)
+        load_model_weights(self.G, join(self.config.model_save_dir, '{}-G.ckpt'.format(args.resume_iters)))
+        self.G.to(self.device)
+
+        settings = args_attack.global_settings
+        self.dataset = CelebA(settings.data_path, settings.attr_path, settings.img_size, args.mode,
+                              self.config.selected_attrs, self.config.selected_attrs)
+        self.attacks = {}
+        self.budget = args.budget
+
+    def attack(self, method):
+        if method not in self.attacks:
+            if method == 'raw':
+                self.attacks[method] = attacks.RobustJPEGAttack.from_config(self.args_attack, model=self.G, device=self.device)
+            else:
+                self.attacks[method] = attacks.LinfPGDAttack.from_config(self.args_attack.attacks, model=self.G,
+                                                                         device=self.device, method=method)
+        return self.attacks[method]
+
+    def __call__(self, job):
+        img, _, c_org = self.dataset[job.index]
+        x_real = img.unsqueeze(0).to(self.device)
+        c_trg = create_labels(c_org.unsqueeze(0), self.config.c_dim, self.config.selected_attrs)[job.target]
+        c_trg = c_trg.to(self.device)
+
+        attack = self.attack(job.method)
+        if job.method == 'raw':
+            X_adv, _ = attack.perturb(x_real, [c_trg], budget=self.budget)
+            return X_adv.cpu()
+
+        # The pixel attacks work on [-1, 1] images
+        x_real = x_real * 2 - 1
+        with torch.no_grad(), attacks.frozen_model(self.G):
+            gen_noattack = self.G(x_real, c_trg)
+        if self.budget is not None:
+            X_adv, _, _ = attack.perturb_deadline(x_real, gen_noattack, c_trg, self.budget)
+        else:
+            X_adv, _ = attack.perturb(x_real, gen_noattack, c_trg)
+        return ((X_adv + 1) / 2).cpu()
+
+
+def worker_loop(worker_cls, worker_args, num_threads, job_queue, result_queue):
+    """
+    Body of a worker process: build the worker state, then run jobs until the None sentinel.
+    A failing job is reported with its traceback instead of killing the process.
+    """
+    torch.set_num_threads(num_threads)
+    run_job = worker_cls(*worker_args)
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+        try:
+            result_queue.put((job.job_id, run_job(job), None))
+        except Exception:
+            result_queue.put((job.job_id, None, traceback.format_exc()))
+
+
+class AttackScheduler(object):
+    def __init__(self, worker_cls, worker_args, num_workers, max_retries=2, queue_size=None, timeout=600):
+        """
+        Runs jobs on a pool of worker processes, each built as worker_cls(*worker_args, seed=rank).
+        The cores are split evenly between the workers (intra-op threads), at most queue_size
+        jobs are in flight so the queues stay bounded, failed jobs are retried up to max_retries
+        times, and results are handed to the writer strictly in job order.
+        timeout: seconds without any result before the workers are checked for a crash
+        """
+        self.worker_cls = worker_cls
+        self.worker_args = worker_args
+        self.num_workers = num_workers
+        self.max_retries = max_retries
+        self.queue_size = queue_size or 2 * num_workers
+        self.timeout = timeout
+        self.num_threads = max(1, os.cpu_count() // num_workers)
+
+    def run(self, jobs, writer):
+        """
+        writer(job, result) is called once per job, in job order; result is None for a job
+        that still failed after all its retries.
+        """
+        ctx = mp.get_context('spawn')
+        job_queue = ctx.Queue(self.queue_size)
+        result_queue = ctx.Queue(self.queue_size)
+        workers = [ctx.Process(target=worker_loop,
+                               args=(self.worker_cls, tuple(self.worker_args) + (rank,), self.num_threads,
+                                     job_queue, result_queue),
+                               daemon=True)
+                   for rank in range(self.num_workers)]
+        for p in workers:
+            p.start()
+
+        pending = deque(jobs)
+        attempts = [0] * len(jobs)
+        done = {}
+        next_id, in_flight, failed = 0, 0, 0
+        # Results waiting for an earlier job are buffered, dispatch stops past this window
+        window = 4 * self.queue_size
+
+        try:
+            while next_id < len(jobs):
+                # In-flight jobs never exceed the queue sizes, so no put() can block
+                while pending and in_flight < self.queue_size and pending[0].job_id < next_id + window:
+                    job_queue.put(pending.popleft())
+                    in_flight += 1
+
+                try:
+                    job_id, result, error = result_queue.get(timeout=self.timeout)
+                except queue.Empty:
+                    if not all(p.is_alive() for p in workers):
+                        raise RuntimeError('A worker process died, {} jobs were in flight.'.format(in_flight))
+                    continue
+                in_flight -= 1
+
+                if error is not None:
+                    attempts[job_id] += 1
+                    if attempts[job_id] <= self.max_retries:
+                        print('Job {} failed, retrying ({}/{})...'.format(job_id, attempts[job_id], self.max_retries))
+                        pending.appendleft(jobs[job_id])
+                        continue
+                    print('Job {} failed after {} retries:\n{}'.format(job_id, self.max_retries, error))
+                    failed += 1
+                done[job_id] = result
+
+                while next_id in done:
+                    writer(jobs[next_id], done.pop(next_id))
+                    next_id += 1
+        finally:
+            for _ in workers:
+                job_queue.put(None)
+            for p in workers:
+                p.join(timeout=self.timeout)
+                if p.is_alive():
+                    p.terminate()
+
+        return failed
+
+
+if __name__ == '__main__':
+    args, args_attack = parse()
+    settings = args_attack.global_settings
+    output = args.output or settings.results_path
+    os.makedirs(output, exist_ok=True)
+
+    # Only the length is needed here, the workers load their own copy of the dataset
+    config = args_attack.stargan
+    dataset = CelebA(settings.data_path, settings.attr_path, settings.img_size, args.mode,
+                     config.selected_attrs, config.selected_attrs)
+    jobs = make_jobs(min(len(dataset), settings.num_test), config.c_dim, args.method)
+
+    def write_result(job, X_adv):
+        if X_adv is None:
+            return
+        result_path = join(output, '{}-{}-{}.png'.format(job.index, job.target, job.method))
+        save_image(X_adv, result_path, nrow=1, padding=0)
+        if job.target == config.c_dim - 1:
+            print('Protected {}/{} images.'.format(job.index + 1, len(jobs) // config.c_dim))
+
+    scheduler = AttackScheduler(StarGANWorker, (args, args_attack), args.workers,
+                                max_retries=args.retries, queue_size=args.queue_size)
+    failed = scheduler.run(jobs, write_result)
+    print('Done, {} of {} jobs failed.'.format(failed, len(jobs)))
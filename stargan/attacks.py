@@ -1,29 +1,75 @@
 import copy
+import os
+import sys
+import time
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from collections import Iterable
 from scipy.stats import truncnorm
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 
 try:
     import defenses.smoothing as smoothing
+    from compact import zigzag
 except:
     import stargan.defenses.smoothing as smoothing
+    from stargan.compact import zigzag
+
+try:
+    from attack_utils import AMP_DTYPES, amp_autocast, LossScaler, input_grad, frozen_model, clip_tensor, clip_tensor_
+except ImportError:
+    # Run from stargan/: the helpers shared with the AttGAN attacks live at the repository root
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from attack_utils import AMP_DTYPES, amp_autocast, LossScaler, input_grad, frozen_model, clip_tensor, clip_tensor_
+
+try:
+    from DiffJPEG.modules import compress_jpeg, decompress_jpeg
+    from DiffJPEG.utils import quality_to_factor
+    from DiffJPEG.DiffJPEG import DiffJPEG
+except ImportError:
+    # DiffJPEG lives at the repository root and is only needed by RobustJPEGAttack
+    compress_jpeg = decompress_jpeg = quality_to_factor = DiffJPEG = None
+
+try:
+    from torch.func import vmap, grad as func_grad
+except ImportError:
+    # torch < 2.0, only needed for per-sample gradients
+    vmap = func_grad = None
+
+# Attack variants: (random start, L1-normalized momentum)
+ATTACK_METHODS = {
+    'pgd': (True, False),
+    'ifgsm': (False, False),
+    'mifgsm': (False, True),
+    'momentum': (True, True),   # MI-FGSM with a random start, as used in RAW.ipynb
+}
 
 class LinfPGDAttack(object):
-    def __init__(self, model=None, device=None, epsilon=0.05, k=10, a=0.01, feat = None):
+    def __init__(self, model=None, device=None, epsilon=0.05, k=10, a=0.01, feat = None, momentum=0.0, amp=None,
+                 checkpoint=None):
         """
-        FGSM, I-FGSM and PGD attacks
+        FGSM, I-FGSM, PGD and MI-FGSM attacks
         epsilon: magnitude of attack
         k: iterations
         a: step size
+            epsilon, k and a are numbers, or tensors with one value per sample of the batch
+            (a sample stops moving after its own k steps)
+        momentum: decay factor of the L1-normalized gradient accumulator (0 disables it)
+        amp: None (fp32), 'bf16' or 'fp16' mixed precision for the generator forward/backward
+        checkpoint: number of gradient checkpointing segments for the generator during the attack
+            (None keeps the model's setting), trading one extra forward for activation memory;
+            the per-sample path always runs without it
         """
         self.model = model
         self.epsilon = epsilon
         self.k = k
         self.a = a
+        self.momentum = momentum
         self.loss_fn = nn.MSELoss().to(device)
         self.device = device
 
@@ -35,77 +81,386 @@ class LinfPGDAttack(object):
 
         # Universal perturbation
         self.up = None
-        
 
-    def perturb(self, X_nat, y, c_trg):
-        """
-        Vanilla Attack.
-        """
-        if self.rand:
-            X = X_nat.clone().detach_() + torch.tensor(np.random.uniform(-self.epsilon, self.epsilon, X_nat.shape).astype('float32')).to(self.device)
-        else:
-            X = X_nat.clone().detach_()
-            # use the following if FGSM or I-FGSM and random seeds are fixed
-            # X = X_nat.clone().detach_() + torch.tensor(np.random.uniform(-0.001, 0.001, X_nat.shape).astype('float32')).cuda()    
+        # Start every attack from this (universal) perturbation instead of the random or zero
+        # start, projected onto each sample's epsilon ball, see load_warm_start()
+        self.warm_start = None
 
-        for i in range(self.k):
-            X.requires_grad = True
-            output, feats = self.model(X, c_trg)
+        # Per-sample momentum buffer, reset at the start of every attack
+        self.g = None
 
-            if self.feat:
-                output = feats[self.feat]
+        # Mixed precision, fp16 gradients go through a dynamic loss scaler
+        self.amp = amp
+        self.scaler = LossScaler() if amp == 'fp16' else None
 
-            self.model.zero_grad()
-            # Minus in the loss means "towards" and plus means "away from"
-            loss = self.loss_fn(output, y)
-            loss.backward()
-            grad = X.grad
+        self.checkpoint = checkpoint
 
-            X_adv = X + self.a * grad.sign()
+        # Optional AttackTelemetry, fed by every step
+        self.telemetry = None
 
-            eta = torch.clamp(X_adv - X_nat, min=-self.epsilon, max=self.epsilon)
-            X = torch.clamp(X_nat + eta, min=-1, max=1).detach_()
+        # Vanilla attack: gradient of every sample's own loss through torch.func
+        self.per_sample = False
 
-        self.model.zero_grad()
+        # Per-sample views of epsilon, a and k for the running attack, set by _init
+        self._eps, self._a, self._k = epsilon, a, k
+        self._i = 0
+        # Preallocated per-sample workspaces of _step (lower bound, active mask, step size)
+        self._lo = self._active = self._step_size = None
 
-        return X, X - X_nat
+    @classmethod
+    def from_config(cls, config, model=None, device=None, method='pgd', feat=None):
+        """
+        Build an attack from the `attacks` block of setting.json (namespace or dict).
+        method: one of ATTACK_METHODS
+        """
+        if not isinstance(config, dict):
+            config = vars(config)
+        rand, use_momentum = ATTACK_METHODS[method]
 
-    def universal_perturb(self, X_nat, y, c_trg):
+        attack = cls(model=model, device=device, epsilon=config['epsilon'], k=config['k'], a=config['a'], feat=feat,
+                     momentum=config['momentum'] if use_momentum else 0.0, amp=config.get('amp'),
+                     checkpoint=config.get('checkpoint'))
+        attack.rand = rand
+        return attack
+
+    def _autocast(self):
+        return amp_autocast(self.device, self.amp)
+
+    def load_warm_start(self, path):
         """
-        Vanilla Attack.
+        Warm-start the attacks from a saved universal perturbation, e.g. the
+        universal_perturbation_path of setting.json.
+        """
+        self.warm_start = torch.load(path, map_location=lambda storage, loc: storage).to(self.device)
+
+    @property
+    def num_steps(self):
+        """Iterations of the attack loop, the largest k of the batch."""
+        return int(self.k.max()) if torch.is_tensor(self.k) else self.k
+
+    @staticmethod
+    def _per_sample(value, X):
+        """Numbers are used as they are, per-sample tensors are shaped to broadcast against X."""
+        if not torch.is_tensor(value):
+            return value
+        return value.to(X.device).view(-1, *([1] * (X.dim() - 1)))
+
+    def _init(self, X_nat):
+        """
+        Starting point of an attack.
         """
-        if self.rand:
+        self.g = None
+        self._eps = self._per_sample(self.epsilon, X_nat)
+        self._a = self._per_sample(self.a, X_nat)
+        self._k = self._per_sample(self.k, X_nat)
+        self._i = 0
+        self._lo = -self._eps
+        if torch.is_tensor(self._k):
+            self._active = torch.empty(self._k.shape, dtype=torch.bool, device=X_nat.device)
+            self._step_size = torch.empty(self._k.shape, device=X_nat.device)
+        if self.telemetry is not None:
+            self.telemetry.begin(self.num_steps, X_nat.size(0), X_nat.device)
+        if self.warm_start is not None:
+            delta = self.warm_start.to(X_nat.device).expand_as(X_nat).clone()
+            X = clip_tensor_(delta, -self._eps, self._eps).add_(X_nat)
+            clip_tensor_(X, -1, 1)
+        elif self.rand and torch.is_tensor(self._eps):
+            X = X_nat.clone().detach_() + torch.tensor(np.random.uniform(-1, 1, X_nat.shape).astype('float32')).to(self.device) * self._eps
+        elif self.rand:
             X = X_nat.clone().detach_() + torch.tensor(np.random.uniform(-self.epsilon, self.epsilon, X_nat.shape).astype('float32')).to(self.device)
         else:
             X = X_nat.clone().detach_()
             # use the following if FGSM or I-FGSM and random seeds are fixed
-            # X = X_nat.clone().detach_() + torch.tensor(np.random.uniform(-0.001, 0.001, X_nat.shape).astype('float32')).cuda()    
+            # X = X_nat.clone().detach_() + torch.tensor(np.random.uniform(-0.001, 0.001, X_nat.shape).astype('float32')).cuda()
+        return X
 
-        for i in range(self.k):
-            X.requires_grad = True
-            output, feats = self.model(X, c_trg)
+    def _step(self, X, X_nat, grad, loss=None):
+        """
+        Fused update: normalize and accumulate the gradient (momentum only), take a signed
+        step, project onto the epsilon ball around X_nat and clamp to the valid range.
+        Allocation-free: X is updated in place and returned detached (same storage), the
+        gradient is consumed as the workspace of the step and the momentum buffer and
+        per-sample bounds are allocated once per attack.
+        loss: optional per-sample loss, only used by the telemetry
+        """
+        with torch.profiler.record_function('LinfPGDAttack._step'):
+            X = X.detach()
+            if self.telemetry is not None:
+                grad_norm = grad.flatten(1).norm(dim=1)
+            if self.momentum:
+                # per-sample L1 normalization, so samples in a batch do not share a scale
+                l1 = grad.norm(p=1, dim=tuple(range(1, grad.dim())), keepdim=True).clamp_(min=1e-12)
+                grad.div_(l1)
+                if self.g is None:
+                    self.g = torch.zeros_like(grad)
+                self.g.mul_(self.momentum).add_(grad)
+                torch.sign(self.g, out=grad)
+            else:
+                grad.sign_()
+
+            if torch.is_tensor(self._k):
+                # samples past their own number of steps stay where they are
+                torch.gt(self._k, self._i, out=self._active)
+                torch.mul(self._active, self._a, out=self._step_size)
+                X.addcmul_(grad, self._step_size)
+            elif torch.is_tensor(self._a):
+                X.addcmul_(grad, self._a)
+            else:
+                X.add_(grad, alpha=self._a)
+            clip_tensor_(X.sub_(X_nat), self._lo, self._eps).add_(X_nat)
+            clip_tensor_(X, -1, 1)
+            if self.telemetry is not None:
+                self.telemetry.record(self._i, grad_norm, (X - X_nat).flatten(1).norm(dim=1), loss)
+            self._i += 1
+        return X
+
+    def _sample_loss(self, output, y):
+        """Per-sample MSE for the telemetry, None when there is none."""
+        if self.telemetry is None:
+            return None
+        return (output.detach().float() - y).pow(2).flatten(1).mean(dim=1)
 
-            if self.feat:
-                output = feats[self.feat]
+    def perturb(self, X_nat, y, c_trg):
+        """
+        Vanilla Attack.
+        """
+        if self.per_sample and self.amp is not None:
+            # torch.func cannot differentiate through autocast, the per-sample path is fp32 only
+            raise ValueError('per_sample gradients do not support amp={!r}, use amp=None'.format(self.amp))
+        X = self._init(X_nat)
+
+        # Checkpointing relies on saved tensor hooks, which torch.func transforms do not support
+        with frozen_model(self.model, 0 if self.per_sample else self.checkpoint):
+            for i in range(self.num_steps):
+                if self.per_sample:
+                    grad, loss = self._per_sample_grad(X, y, c_trg)
+                    X = self._step(X, X_nat, grad, loss if self.telemetry is not None else None)
+                    continue
+
+                X.requires_grad = True
+                with self._autocast():
+                    if self.feat:
+                        output = self.model.forward_to(X, c_trg, self.feat)
+                    else:
+                        output = self.model(X, c_trg)
+
+                    # Minus in the loss means "towards" and plus means "away from"
+                    loss = self.loss_fn(output, y)
+                grad = input_grad(loss, X, self.scaler)
+
+                X = self._step(X, X_nat, grad, self._sample_loss(output, y))
 
-            self.model.zero_grad()
-            # Minus in the loss means "towards" and plus means "away from"
+        return X, X - X_nat
+
+    def _per_sample_grad(self, X, y, c_trg):
+        """
+        d(loss_b)/dX_b for every sample b: torch.func grad of one sample's loss, vmapped
+        over the batch, so nothing in the forward pass can couple the samples' gradients.
+        fp32 only (see perturb). Returns the gradients and the per-sample losses.
+        """
+        def sample_loss(x, y, c):
+            x, y, c = x.unsqueeze(0), y.unsqueeze(0), c.unsqueeze(0)
+            if self.feat:
+                output = self.model.forward_to(x, c, self.feat)
+            else:
+                output = self.model(x, c)
             loss = self.loss_fn(output, y)
-            loss.backward()
-            grad = X.grad
+            return loss, loss.detach()
 
-            X_adv = X + self.a * grad.sign()
+        return vmap(func_grad(sample_loss, has_aux=True))(X.detach(), y, c_trg)
 
-            if self.up is None:
-                eta = torch.clamp(X_adv - X_nat, min=-self.epsilon, max=self.epsilon).detach_()
-                self.up = eta
-            else:
-                eta = torch.clamp(X_adv - X_nat, min=-self.epsilon, max=self.epsilon).detach_()
-                self.up = self.up * 0.9 + eta * 0.1
-            X = torch.clamp(X_nat + self.up, min=-1, max=1).detach_()
+    def perturb_multiscale(self, X_nat, y, c_trg, schedule=((0.5, 7), (1.0, 3))):
+        """
+        Coarse-to-fine vanilla attack. The generators are fully convolutional, so the first
+        stages attack area-downsampled images (against the clean output at that resolution),
+        and each stage starts from the bilinearly upsampled perturbation of the previous one.
+        schedule: (scale, steps) stages from coarse to fine, replacing k; finish at scale 1.0
+        """
+        k, warm_start = self.k, self.warm_start
+        delta = warm_start
+        try:
+            for scale, steps in schedule:
+                size = [int(round(s * scale)) for s in X_nat.shape[2:]]
+                if size == list(X_nat.shape[2:]):
+                    X_s, y_s = X_nat, y
+                else:
+                    X_s = F.interpolate(X_nat, size=size, mode='area')
+                    with torch.no_grad(), frozen_model(self.model):
+                        if self.feat:
+                            y_s = self.model.forward_to(X_s, c_trg, self.feat)
+                        else:
+                            y_s = self.model(X_s, c_trg)
+                if delta is not None and list(delta.shape[2:]) != size:
+                    delta = F.interpolate(delta, size=size, mode='bilinear', align_corners=False)
+                self.k, self.warm_start = steps, delta
+                _, delta = self.perturb(X_s, y_s, c_trg)
+        finally:
+            self.k, self.warm_start = k, warm_start
+
+        if list(delta.shape[2:]) != list(X_nat.shape[2:]):
+            delta = F.interpolate(delta, size=X_nat.shape[2:], mode='bilinear', align_corners=False)
+        X = clip_tensor(X_nat + delta, -1, 1)
+        return X, X - X_nat
 
-        self.model.zero_grad()
-        
+    def perturb_deadline(self, X_nat, y, c_trg, budget, threshold=0.05, max_steps=None):
+        """
+        Vanilla attack under a time budget (seconds) instead of k iterations.
+        Every iteration only runs the samples whose distortion (per-sample MSE to y, as
+        prop_dist counts it) is still below threshold, a sample leaves the batch as soon as
+        it passes. The loop stops when another iteration would not fit in the budget (timed
+        on the previous one), when every sample passed, or after max_steps.
+        Returns, for every sample, the most distorting perturbation evaluated so far and its
+        distortion. The telemetry is not fed.
+        """
+        start = time.time()
+        X = self._init(X_nat)
+        best = X.clone()
+        best_dist = torch.full((X.size(0),), -float('inf'), device=X.device)
+        active = torch.arange(X.size(0), device=X.device)
+
+        def rows(value, index):
+            return value.view(-1)[index].view(-1, *([1] * (X.dim() - 1))) if torch.is_tensor(value) else value
+
+        i = 0
+        with frozen_model(self.model, self.checkpoint):
+            while active.numel() and (max_steps is None or i < max_steps):
+                iteration_start = time.time()
+                X_a = X[active].requires_grad_(True)
+                with self._autocast():
+                    if self.feat:
+                        output = self.model.forward_to(X_a, c_trg[active], self.feat)
+                    else:
+                        output = self.model(X_a, c_trg[active])
+                    dist = (output.float() - y[active]).pow(2).flatten(1).mean(dim=1)
+                    loss = dist.mean()
+
+                dist = dist.detach()
+                better = dist > best_dist[active]
+                best[active[better]] = X_a.detach()[better]
+                best_dist[active[better]] = dist[better]
+                keep = dist <= threshold
+                if not keep.any():
+                    break
+                grad = input_grad(loss, X_a, self.scaler)[keep]
+
+                # The step of _step, on the samples still running
+                with torch.no_grad():
+                    active = active[keep]
+                    if self.momentum:
+                        grad.div_(grad.norm(p=1, dim=tuple(range(1, grad.dim())), keepdim=True).clamp_(min=1e-12))
+                        if self.g is None:
+                            self.g = torch.zeros_like(X)
+                        self.g[active] = self.g[active].mul_(self.momentum).add_(grad)
+                        grad = self.g[active]
+                    X_a = X_a.detach()[keep].add_(grad.sign_().mul_(rows(self._a, active)))
+                    eps = rows(self._eps, active)
+                    clip_tensor_(X_a.sub_(X_nat[active]), -eps, eps).add_(X_nat[active])
+                    X[active] = clip_tensor_(X_a, -1, 1)
+                i += 1
+
+                now = time.time()
+                if now + (now - iteration_start) > start + budget:
+                    break
+
+        return best, best - X_nat, best_dist
+
+    def search_epsilon(self, X_nat, y, c_trg, epsilon_max=None, candidates=4, rounds=3, threshold=0.05):
+        """
+        Smallest epsilon per image for which the vanilla attack pushes the output distortion
+        (MSE to y, as prop_dist counts it) past threshold.
+        Every round attacks the stack of `candidates` budgets spread over each image's
+        current interval as one batch: the smallest successful budget becomes the upper end,
+        the candidate below it the lower end. The first round tests the upper end itself,
+        later ones only interior points (the upper end is known to succeed), a
+        (candidates + 1)-section search.
+        The step size is scaled with the budget, and every round warm-starts from the
+        best perturbations of the previous one.
+        epsilon_max: upper end of the search, a number or one per image (self.epsilon by default)
+        Returns the images perturbed at their budget and the per-image epsilon map, NaN
+        where even epsilon_max does not reach the threshold.
+        """
+        B, C = X_nat.size(0), candidates
+        if epsilon_max is None:
+            epsilon_max = self.epsilon
+        hi = torch.as_tensor(epsilon_max, dtype=torch.float32, device=X_nat.device).expand(B).clone()
+        lo = torch.zeros_like(hi)
+        found = torch.zeros(B, dtype=torch.bool, device=X_nat.device)
+        best = None
+
+        def stacked(value):
+            return value.to(X_nat.device).repeat_interleave(C, dim=0) if torch.is_tensor(value) else value
+
+        X_rep, y_rep, c_rep = stacked(X_nat), stacked(y), stacked(c_trg)
+        steps = torch.arange(1, C + 1, dtype=torch.float32, device=X_nat.device)
+        epsilon, a, k, warm_start = self.epsilon, self.a, self.k, self.warm_start
+        ratio = stacked(a / epsilon) if torch.is_tensor(a / epsilon) else a / epsilon
+        try:
+            self.k = stacked(k)
+            self.warm_start = stacked(warm_start) if torch.is_tensor(warm_start) and warm_start.size(0) == B else warm_start
+            for r in range(rounds):
+                fractions = steps / C if r == 0 else steps / (C + 1)
+                eps = lo.unsqueeze(1) + (hi - lo).unsqueeze(1) * fractions
+                self.epsilon = eps.flatten()
+                self.a = self.epsilon * ratio
+                _, delta = self.perturb(X_rep, y_rep, c_rep)
+                # Judged on the same forward as the attack itself
+                with torch.no_grad(), frozen_model(self.model), self._autocast():
+                    if self.feat:
+                        output = self.model.forward_to(X_rep + delta, c_rep, self.feat)
+                    else:
+                        output = self.model(X_rep + delta, c_rep)
+                    dist = (output.float() - y_rep).pow(2).flatten(1).mean(dim=1).view(B, C)
+
+                # Smallest successful candidate, or the largest one when none is
+                success = dist > threshold
+                reached = success.any(dim=1)
+                j = torch.where(reached, success.float().argmax(dim=1), torch.full_like(lo, C - 1, dtype=torch.long))
+                hi = torch.where(reached, eps.gather(1, j.unsqueeze(1)).squeeze(1), hi)
+                below = torch.where(j > 0, eps.gather(1, (j - 1).clamp(min=0).unsqueeze(1)).squeeze(1), lo)
+                lo = torch.where(reached, below, eps[:, -1])
+                delta = delta.view(B, C, *delta.shape[1:])[torch.arange(B, device=delta.device), j]
+                best = delta if best is None else torch.where(reached.view(-1, *([1] * (delta.dim() - 1))), delta, best)
+                found |= reached
+                self.warm_start = stacked(best)
+        finally:
+            self.epsilon, self.a, self.k, self.warm_start = epsilon, a, k, warm_start
+
+        X = clip_tensor(X_nat + best, -1, 1)
+        return X, torch.where(found, hi, torch.full_like(hi, float('nan')))
+
+    def universal_perturb(self, X_nat, y, c_trg):
+        """
+        Vanilla Attack.
+        """
+        X = self._init(X_nat)
+
+        with frozen_model(self.model, self.checkpoint):
+            for i in range(self.num_steps):
+                X.requires_grad = True
+                with self._autocast():
+                    if self.feat:
+                        output = self.model.forward_to(X, c_trg, self.feat)
+                    else:
+                        output = self.model(X, c_trg)
+
+                    # Minus in the loss means "towards" and plus means "away from"
+                    loss = self.loss_fn(output, y)
+                grad = input_grad(loss, X, self.scaler)
+
+                with torch.no_grad():
+                    # eta = clip(X + a * sign(grad) - X_nat), built in the gradient's storage
+                    eta = grad.sign_().mul_(self._a).add_(X).sub_(X_nat)
+                    clip_tensor_(eta, self._lo, self._eps)
+
+                    # One perturbation for the whole batch
+                    if self.up is None:
+                        self.up = eta.mean(dim=0, keepdim=True)
+                    else:
+                        self.up.mul_(0.9).add_(eta.mean(dim=0, keepdim=True), alpha=0.1)
+                    # Shared by every sample, so within the smallest per-sample epsilon
+                    bound = self._eps.min() if torch.is_tensor(self._eps) else self._eps
+                    clip_tensor_(self.up, -bound, bound)
+                    X = clip_tensor_(torch.add(X_nat, self.up, out=X.detach()), -1, 1)
 
         return X, X - X_nat
 
@@ -113,12 +468,7 @@ class LinfPGDAttack(object):
         """
         White-box attack against blur pre-processing.
         """
-        if self.rand:
-            X = X_nat.clone().detach_() + torch.tensor(np.random.uniform(-self.epsilon, self.epsilon, X_nat.shape).astype('float32')).to(self.device)
-        else:
-            X = X_nat.clone().detach_()
-            # use the following if FGSM or I-FGSM and random seeds are fixed
-            # X = X_nat.clone().detach_() + torch.tensor(np.random.uniform(-0.001, 0.001, X_nat.shape).astype('float32')).cuda()  
+        X = self._init(X_nat)
               
         X_orig = X_nat.clone().detach_()
 
@@ -133,21 +483,16 @@ class LinfPGDAttack(object):
         # blurred_image = smoothing.AverageSmoothing2D(channels=3, kernel_size=ks).to(self.device)(X_orig)
         blurred_image = smoothing.GaussianSmoothing2D(sigma=sig, channels=3, kernel_size=ks).to(self.device)(X_orig)
 
-        for i in range(self.k):
-            X.requires_grad = True
-            output, feats = self.model.forward_blur(X, c_trg, preproc)
-
-            self.model.zero_grad()
-            loss = self.loss_fn(output, y)
-            loss.backward()
-            grad = X.grad
+        with frozen_model(self.model, self.checkpoint):
+            for i in range(self.num_steps):
+                X.requires_grad = True
+                with self._autocast():
+                    output = self.model.forward_blur(X, c_trg, preproc)
 
-            X_adv = X + self.a * grad.sign()
+                    loss = self.loss_fn(output, y)
+                grad = input_grad(loss, X, self.scaler)
 
-            eta = torch.clamp(X_adv - X_nat, min=-self.epsilon, max=self.epsilon)
-            X = torch.clamp(X_nat + eta, min=-1, max=1).detach_()
-
-        self.model.zero_grad()
+                X = self._step(X, X_nat, grad)
 
         return X, X - X_nat, blurred_image
 
@@ -155,12 +500,7 @@ class LinfPGDAttack(object):
         """
         Spread-spectrum attack against blur defenses (gray-box scenario).
         """
-        if self.rand:
-            X = X_nat.clone().detach_() + torch.tensor(np.random.uniform(-self.epsilon, self.epsilon, X_nat.shape).astype('float32')).to(self.device)
-        else:
-            X = X_nat.clone().detach_()
-            # use the following if FGSM or I-FGSM and random seeds are fixed
-            # X = X_nat.clone().detach_() + torch.tensor(np.random.uniform(-0.001, 0.001, X_nat.shape).astype('float32')).cuda()  
+        X = self._init(X_nat)
 
         # Gaussian blur kernel size
         ks_gauss = 11
@@ -171,42 +511,37 @@ class LinfPGDAttack(object):
         # Type of blur
         blur_type = 1
 
-        for i in range(self.k):
-            # Declare smoothing layer
-            if blur_type == 1:
-                preproc = smoothing.GaussianSmoothing2D(sigma=sig, channels=3, kernel_size=ks_gauss).to(self.device)
-            elif blur_type == 2:
-                preproc = smoothing.AverageSmoothing2D(channels=3, kernel_size=ks_avg).to(self.device)
-
-            X.requires_grad = True
-            output, feats = self.model.forward_blur(X, c_trg, preproc)
-
-            if self.feat:
-                output = feats[self.feat]
-
-            self.model.zero_grad()
-            loss = self.loss_fn(output, y)
-            loss.backward()
-            grad = X.grad
+        with frozen_model(self.model, self.checkpoint):
+            for i in range(self.num_steps):
+                # Declare smoothing layer
+                if blur_type == 1:
+                    preproc = smoothing.GaussianSmoothing2D(sigma=sig, channels=3, kernel_size=ks_gauss).to(self.device)
+                elif blur_type == 2:
+                    preproc = smoothing.AverageSmoothing2D(channels=3, kernel_size=ks_avg).to(self.device)
 
-            X_adv = X + self.a * grad.sign()
+                X.requires_grad = True
+                with self._autocast():
+                    if self.feat:
+                        output = self.model.forward_to(X, c_trg, self.feat, blur_layer=preproc)
+                    else:
+                        output = self.model.forward_blur(X, c_trg, preproc)
 
-            eta = torch.clamp(X_adv - X_nat, min=-self.epsilon, max=self.epsilon)
-            X = torch.clamp(X_nat + eta, min=-1, max=1).detach_()
+                    loss = self.loss_fn(output, y)
+                grad = input_grad(loss, X, self.scaler)
 
-            # Iterate through blur types
-            if blur_type == 1:
-                sig += 0.5
-                if sig >= 3.2:
-                    blur_type = 2
-                    sig = 1
-            if blur_type == 2:
-                ks_avg += 2
-                if ks_avg >= 11:
-                    blur_type = 1
-                    ks_avg = 3
+                X = self._step(X, X_nat, grad)
 
-        self.model.zero_grad()
+                # Iterate through blur types
+                if blur_type == 1:
+                    sig += 0.5
+                    if sig >= 3.2:
+                        blur_type = 2
+                        sig = 1
+                if blur_type == 2:
+                    ks_avg += 2
+                    if ks_avg >= 11:
+                        blur_type = 1
+                        ks_avg = 3
 
         return X, X - X_nat
 
@@ -214,12 +549,7 @@ class LinfPGDAttack(object):
         """
         EoT adaptation to the blur transformation.
         """
-        if self.rand:
-            X = X_nat.clone().detach_() + torch.tensor(np.random.uniform(-self.epsilon, self.epsilon, X_nat.shape).astype('float32')).to(self.device)
-        else:
-            X = X_nat.clone().detach_()
-            # use the following if FGSM or I-FGSM and random seeds are fixed
-            # X = X_nat.clone().detach_() + torch.tensor(np.random.uniform(-0.001, 0.001, X_nat.shape).astype('float32')).cuda()  
+        X = self._init(X_nat)
 
         # Gaussian blur kernel size
         ks_gauss = 11
@@ -230,44 +560,39 @@ class LinfPGDAttack(object):
         # Type of blur
         blur_type = 1
 
-        for i in range(self.k):
-            full_loss = 0.0
-            X.requires_grad = True
-            self.model.zero_grad()
+        with frozen_model(self.model, self.checkpoint):
+            for i in range(self.num_steps):
+                full_loss = 0.0
+                X.requires_grad = True
+                with self._autocast():
 
-            for j in range(9):  # 9 types of blur
-                # Declare smoothing layer
-                if blur_type == 1:
-                    preproc = smoothing.GaussianSmoothing2D(sigma=sig, channels=3, kernel_size=ks_gauss).to(self.device)
-                elif blur_type == 2:
-                    preproc = smoothing.AverageSmoothing2D(channels=3, kernel_size=ks_avg).to(self.device)
+                    for j in range(9):  # 9 types of blur
+                        # Declare smoothing layer
+                        if blur_type == 1:
+                            preproc = smoothing.GaussianSmoothing2D(sigma=sig, channels=3, kernel_size=ks_gauss).to(self.device)
+                        elif blur_type == 2:
+                            preproc = smoothing.AverageSmoothing2D(channels=3, kernel_size=ks_avg).to(self.device)
 
             
-                output, feats = self.model.forward_blur(X, c_trg, preproc)
+                        output = self.model.forward_blur(X, c_trg, preproc)
             
-                loss = self.loss_fn(output, y)
-                full_loss += loss
+                        loss = self.loss_fn(output, y)
+                        full_loss += loss
 
-                if blur_type == 1:
-                    sig += 0.5
-                    if sig >= 3.2:
-                        blur_type = 2
-                        sig = 1
-                if blur_type == 2:
-                    ks_avg += 2
-                    if ks_avg >= 11:
-                        blur_type = 1
-                        ks_avg = 3
-                
-            full_loss.backward()
-            grad = X.grad
-
-            X_adv = X + self.a * grad.sign()
+                        if blur_type == 1:
+                            sig += 0.5
+                            if sig >= 3.2:
+                                blur_type = 2
+                                sig = 1
+                        if blur_type == 2:
+                            ks_avg += 2
+                            if ks_avg >= 11:
+                                blur_type = 1
+                                ks_avg = 3
 
-            eta = torch.clamp(X_adv - X_nat, min=-self.epsilon, max=self.epsilon)
-            X = torch.clamp(X_nat + eta, min=-1, max=1).detach_()
+                grad = input_grad(full_loss, X, self.scaler)
 
-        self.model.zero_grad()
+                X = self._step(X, X_nat, grad)
 
         return X, X - X_nat
 
@@ -276,88 +601,477 @@ class LinfPGDAttack(object):
         """
         Iterative Class Conditional Attack
         """
-        if self.rand:
-            X = X_nat.clone().detach_() + torch.tensor(np.random.uniform(-self.epsilon, self.epsilon, X_nat.shape).astype('float32')).to(self.device)
-        else:
-            X = X_nat.clone().detach_()
-            # use the following if FGSM or I-FGSM and random seeds are fixed
-            # X = X_nat.clone().detach_() + torch.tensor(np.random.uniform(-0.001, 0.001, X_nat.shape).astype('float32')).cuda()  
+        X = self._init(X_nat)
 
         j = 0
         J = len(c_trg)
 
-        for i in range(self.k):
-            X.requires_grad = True
-            output, feats = self.model(X, c_trg[j])
-
-            self.model.zero_grad()
+        with frozen_model(self.model, self.checkpoint):
+            for i in range(self.num_steps):
+                X.requires_grad = True
+                with self._autocast():
+                    output = self.model(X, c_trg[j])
 
-            loss = self.loss_fn(output, y)
-            loss.backward()
-            grad = X.grad
-
-            X_adv = X + self.a * grad.sign()
+                    loss = self.loss_fn(output, y)
+                grad = input_grad(loss, X, self.scaler)
 
-            eta = torch.clamp(X_adv - X_nat, min=-self.epsilon, max=self.epsilon)
-            X = torch.clamp(X_nat + eta, min=-1, max=1).detach_()
+                X = self._step(X, X_nat, grad)
 
-            j += 1
-            if j == J:
-                j = 0
+                j += 1
+                if j == J:
+                    j = 0
 
-        return X, eta
+        return X, X - X_nat
 
     def perturb_joint_class(self, X_nat, y, c_trg):
         """
         Joint Class Conditional Attack
         """
-        if self.rand:
-            X = X_nat.clone().detach_() + torch.tensor(np.random.uniform(-self.epsilon, self.epsilon, X_nat.shape).astype('float32')).to(self.device)
-        else:
-            X = X_nat.clone().detach_()
-            # use the following if FGSM or I-FGSM and random seeds are fixed
-            # X = X_nat.clone().detach_() + torch.tensor(np.random.uniform(-0.001, 0.001, X_nat.shape).astype('float32')).cuda()  
+        X = self._init(X_nat)
 
         J = len(c_trg)
         
-        for i in range(self.k):
-            full_loss = 0.0
-            X.requires_grad = True
-            self.model.zero_grad()
+        with frozen_model(self.model, self.checkpoint):
+            for i in range(self.num_steps):
+                full_loss = 0.0
+                X.requires_grad = True
+                with self._autocast():
 
-            for j in range(J):
-                output, feats = self.model(X, c_trg[j])
+                    for j in range(J):
+                        output = self.model(X, c_trg[j])
 
-                loss = self.loss_fn(output, y)
-                full_loss += loss
+                        loss = self.loss_fn(output, y)
+                        full_loss += loss
 
-            full_loss.backward()
-            grad = X.grad
+                grad = input_grad(full_loss, X, self.scaler)
 
-            X_adv = X + self.a * grad.sign()
+                X = self._step(X, X_nat, grad)
 
-            eta = torch.clamp(X_adv - X_nat, min=-self.epsilon, max=self.epsilon)
-            X = torch.clamp(X_nat + eta, min=-1, max=1).detach_()
+        return X, X - X_nat
 
-        return X, eta
+# setting.json weights of the generators an ensemble attack can target
+MODEL_FACTORS = {
+    'stargan': 'star_factor',
+    'attentiongan': 'attention_factor',
+    'attgan': 'att_factor',
+    'hisd': 'HiSD_factor',
+}
+
+class EnsembleAttack(LinfPGDAttack):
+    def __init__(self, device=None, epsilon=0.05, k=10, a=0.01, momentum=0.0, factors=None, amp=None, checkpoint=None,
+                 workers=None):
+        """
+        One shared perturbation against several generators.
+        Every step, each registered generator computes its weighted loss gradient w.r.t. the
+        input on its own thread (ATen releases the GIL), and the gradients are summed into a
+        single update, so a step costs about as much as the slowest generator.
+        Only perturb(X_nat, targets) is available, the single-generator attacks of
+        LinfPGDAttack raise NotImplementedError.
+        factors: optional dict name -> weight, used when add_model() is not given a weight
+        workers: size of the thread pool (one per supported generator by default); release
+            it with close(), or use the attack as a context manager
+        """
+        super(EnsembleAttack, self).__init__(model=None, device=device, epsilon=epsilon, k=k, a=a, momentum=momentum, amp=amp,
+                                             checkpoint=checkpoint)
+        # One loss scaler per generator, their gradients have different magnitudes
+        self.scalers = {}
+        self.factors = factors or {}
+        self.models = {}
+        # Threads are only started on demand, up to workers
+        self.pool = ThreadPoolExecutor(max_workers=workers or len(MODEL_FACTORS))
+
+    def close(self):
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @classmethod
+    def from_config(cls, config, device=None, method='pgd'):
+        """
+        Build the ensemble from the `attacks` block of setting.json, including the per-model factors.
+        """
+        if not isinstance(config, dict):
+            config = vars(config)
+        rand, use_momentum = ATTACK_METHODS[method]
+
+        factors = {name: config[key] for name, key in MODEL_FACTORS.items() if key in config}
+        attack = cls(device=device, epsilon=config['epsilon'], k=config['k'], a=config['a'],
+                     momentum=config['momentum'] if use_momentum else 0.0, factors=factors, amp=config.get('amp'),
+                     checkpoint=config.get('checkpoint'))
+        attack.rand = rand
+        return attack
+
+    def add_model(self, name, model, weight=None):
+        """
+        Register a generator under `name`; the weight defaults to the configured factor.
+        """
+        if weight is None:
+            weight = self.factors.get(name, 1.0)
+        self.models[name] = (model, weight)
+        self.scalers[name] = LossScaler() if self.amp == 'fp16' else None
+
+    def perturb(self, X_nat, targets):
+        """
+        X_nat: batch of images in [-1, 1]
+        targets: dict name -> (forward, y), where forward(model, X) runs that registered
+            generator on X (e.g. lambda G, X: G(X, c_trg)) and y is its output to move away from.
+        """
+        X = self._init(X_nat)
+
+        with ExitStack() as stack:
+            for name in targets:
+                stack.enter_context(frozen_model(self.models[name][0], self.checkpoint))
 
-def clip_tensor(X, Y, Z):
-    # Clip X with Y min and Z max
-    X_np = X.data.cpu().numpy()
-    Y_np = Y.data.cpu().numpy()
-    Z_np = Z.data.cpu().numpy()
-    X_clipped = np.clip(X_np, Y_np, Z_np)
-    X_res = torch.FloatTensor(X_clipped)
-    return X_res
+            for i in range(self.num_steps):
+                futures = [self.pool.submit(self._model_grad, name, forward, X, y)
+                           for name, (forward, y) in targets.items()]
+                grad = futures[0].result()
+                for future in futures[1:]:
+                    grad.add_(future.result())
+
+                X = self._step(X, X_nat, grad)
+
+        return X, X - X_nat
+
+    def _model_grad(self, name, forward, X, y):
+        """
+        Weighted input gradient of one generator, run on a worker thread.
+        """
+        model, weight = self.models[name]
+        # Separate leaf per thread, sharing X's storage
+        X = X.detach().requires_grad_(True)
+        # Autocast state is per thread, so it is entered here
+        with self._autocast():
+            loss = weight * self.loss_fn(forward(model, X), y)
+        return input_grad(loss, X, self.scalers[name])
+
+    def _single_model(self, *args, **kwargs):
+        raise NotImplementedError('EnsembleAttack only implements perturb(X_nat, targets)')
+
+    # The inherited attacks run self.model, which an ensemble does not have
+    perturb_multiscale = perturb_deadline = search_epsilon = universal_perturb = _single_model
+    perturb_blur = perturb_blur_iter_full = perturb_blur_eot = _single_model
+    perturb_iter_class = perturb_joint_class = _single_model
+
+class RobustJPEGAttack(object):
+    def __init__(self, model=None, device=None, epsilon=0.001, k=15, a=0.02, momentum=0.7, alpha=0.2,
+                 quality=50, img_size=256, eot_qualities=None, eot_samples=None, eot_shifts=None, amp=None,
+                 checkpoint=None, coefficient_mask=None, mask_k=16):
+        """
+        RAW: JPEG-robust attack in the DCT domain.
+        The quantized Y coefficients of the image are perturbed, so the watermark is
+        already expressed on the JPEG grid and survives compression.
+        epsilon: magnitude of the random start on the Y coefficients
+        k: iterations
+        a: step size on the Y coefficients
+        momentum: decay factor of the L1-normalized gradient accumulator
+        alpha: weight of the L1 term between the JPEG image and the original image
+        quality: JPEG quality the coefficients are computed for
+        eot_qualities: optional list of JPEG qualities the protected image may be recompressed at.
+            When given, every step averages the loss over a JPEG round trip at eot_samples of
+            them (all by default), run as one batch.
+        eot_shifts: optional number of (dx, dy) JPEG grid offsets in [0, 8)^2 sampled per step (64 for
+            all of them), for images that get cropped before recompression. Every offset is a crop by
+            (dx, dy), replicate-padded back to size, a JPEG round trip (at the eot_qualities, or at
+            quality) and the inverse shift, and all of them go through the generator as one batch.
+        amp: None (fp32), 'bf16' or 'fp16' mixed precision for the generator only; the
+            coefficients and the JPEG transforms stay in fp32
+        checkpoint: number of gradient checkpointing segments for the generator during the attack
+        coefficient_mask: optional restriction of the attack to mask_k Y coefficients per block:
+            'zigzag' (the low-frequency band), 'importance' (the largest quantized coefficients
+            of each block) or 'gradient' (the largest gradients of a probe step). Only those are
+            optimized, and each step adds their inverse DCT to the image decoded once.
+        """
+        self.model = model
+        self.epsilon = epsilon
+        self.k = k
+        self.a = a
+        self.momentum = momentum
+        self.alpha = alpha
+        self.coefficient_mask = coefficient_mask
+        self.mask_k = mask_k
+        self.loss_fn = nn.L1Loss().to(device)
+        self.device = device
+
+        factor = quality_to_factor(quality)
+        self.compress = compress_jpeg(factor=factor).to(device).requires_grad_(False)
+        self.decompress = decompress_jpeg(img_size, img_size, factor=factor).to(device).requires_grad_(False)
+
+        # Expectation over recompression qualities and JPEG grid offsets
+        self.quality = quality
+        self.eot_qualities = eot_qualities
+        self.eot_samples = eot_samples
+        self.eot_shifts = eot_shifts
+        if eot_qualities is not None or eot_shifts is not None:
+            self.jpeg = DiffJPEG(img_size, img_size, differentiable=True).to(device).requires_grad_(False)
+
+        # Per-sample momentum buffer, reset at the start of every attack
+        self.g = None
+
+        # Optional universal perturbation to start from instead of the random start, either
+        # on the Y coefficients ('dct') or on [-1, 1] images ('pixel'), see load_warm_start()
+        self.warm_start = None
+        self.warm_start_domain = 'dct'
+
+        self.amp = amp
+        self.scaler = LossScaler() if amp == 'fp16' else None
+
+        self.checkpoint = checkpoint
+
+        # Optional AttackTelemetry, the perturbation norm is taken on the Y coefficients
+        self.telemetry = None
+
+    @classmethod
+    def from_config(cls, config, model=None, device=None):
+        """
+        Build the attack from setting.json (the whole namespace: attacks, jpeg and global_settings are read).
+        """
+        return cls(model=model, device=device, epsilon=config.attacks.epsilon, k=config.attacks.k,
+                   a=config.attacks.a, momentum=config.attacks.momentum, quality=config.jpeg.quality,
+                   img_size=config.global_settings.img_size,
+                   eot_qualities=getattr(config.jpeg, 'eot_qualities', None),
+                   eot_samples=getattr(config.jpeg, 'eot_samples', None),
+                   eot_shifts=getattr(config.jpeg, 'eot_shifts', None),
+                   amp=getattr(config.attacks, 'amp', None),
+                   checkpoint=getattr(config.attacks, 'checkpoint', None),
+                   coefficient_mask=getattr(config.jpeg, 'coefficient_mask', None),
+                   mask_k=getattr(config.jpeg, 'mask_k', 16))
+
+    def perturb(self, X_nat, c_trg_list, gen_noattack=None, budget=None):
+        """
+        X_nat: batch of images in [0, 1]
+        c_trg_list: list of target domain labels, all of them are attacked jointly
+        gen_noattack: optional clean outputs for the targets, concatenated in c_trg_list order
+            (e.g. from a ReferenceCache); computed here when not given
+        budget: optional time budget of the call in seconds, the loop stops before k iterations
+            when another one would not fit (timed on the previous one), as in
+            LinfPGDAttack.perturb_deadline
+        Returns the protected images (decoded from the perturbed coefficients) and their Y coefficients.
+        """
+        start = time.time()
+        T = len(c_trg_list)
+        c_trg = torch.cat(c_trg_list, dim=0)
+
+        with torch.no_grad():
+            y_nat, cb, cr = self.compress(X_nat)
+
+        self.g = None
+        if self.warm_start is not None:
+            y = self._warm_start(X_nat, y_nat)
+        else:
+            y = y_nat + torch.empty_like(y_nat).uniform_(-self.epsilon, self.epsilon)
+        if self.telemetry is not None:
+            self.telemetry.begin(self.k, X_nat.size(0), X_nat.device)
+
+        with frozen_model(self.model, self.checkpoint):
+            if gen_noattack is None:
+                with torch.no_grad():
+                    # The generators work on [-1, 1] images
+                    gen_noattack = self.model((X_nat * 2 - 1).repeat(T, 1, 1, 1), c_trg)
+
+            if self.coefficient_mask is None:
+                # Every Y coefficient is optimized
+                theta, theta_nat = y, y_nat
+                decode = lambda theta: self.decompress(theta, cb, cr)
+            else:
+                index = self._coefficient_index(y, y_nat, cb, cr, X_nat, c_trg, gen_noattack, T)
+                # The masked-out coefficients keep their clean values, start included
+                y = y_nat.flatten(2).scatter(2, index, y.detach().flatten(2).gather(2, index)).view_as(y)
+                decode = self._partial_decoder(y, cb, cr, index)
+                theta, theta_nat = y.flatten(2).gather(2, index), y_nat.flatten(2).gather(2, index)
+
+            for i in range(self.k):
+                iteration_start = time.time()
+                theta.requires_grad = True
+                X_jpeg = decode(theta)
+                loss, output, reference = self._objective(X_jpeg, X_nat, c_trg, T, gen_noattack)
+                grad = input_grad(loss, theta, self.scaler)
+
+                if self.telemetry is not None:
+                    # Per-image terms of the loss, they average to the loss itself
+                    sample_loss = self.alpha * (X_jpeg - X_nat).detach().abs().flatten(1).mean(dim=1) \
+                        + T * (output - reference).detach().abs().transpose(0, 2).flatten(1).mean(dim=1)
+                    grad_norm = grad.flatten(1).norm(dim=1)
+
+                theta = self._step(theta, grad)
+
+                if self.telemetry is not None:
+                    self.telemetry.record(i, grad_norm, (theta - theta_nat).flatten(1).norm(dim=1), sample_loss)
+
+                now = time.time()
+                if budget is not None and i < self.k - 1 and now + (now - iteration_start) > start + budget:
+                    if self.telemetry is not None:
+                        # The iterations left stay NaN in the log
+                        self.telemetry.flush()
+                    break
+
+        with torch.no_grad():
+            if self.coefficient_mask is not None:
+                theta = y.flatten(2).scatter(2, index, theta).view_as(y)
+            y = theta
+            X_adv = self.decompress(y, cb, cr)
+
+        return X_adv, y
+
+    def _objective(self, X_jpeg, X_nat, c_trg, T, gen_noattack):
+        """
+        Loss of the decoded images X_jpeg over the T targets and the EoT samples, with the
+        generator outputs and their references, both (T, n_eot, B, C, H, W).
+        """
+        X_eot = self._eot(X_jpeg)
+        n_eot = X_eot.size(0) // X_jpeg.size(0)
+        c_eot = c_trg.view(T, 1, -1, c_trg.size(1)).expand(-1, n_eot, -1, -1).reshape(-1, c_trg.size(1))
+        with amp_autocast(self.device, self.amp):
+            output = self.model((X_eot * 2 - 1).repeat(T, 1, 1, 1), c_eot)
+        output = output.float()
+
+        # Sum of the per-target distortions averaged over the EoT samples,
+        # the mean over the stacked batch divides by T
+        output = output.view(T, n_eot, *X_jpeg.shape)
+        reference = gen_noattack.view(T, 1, *X_jpeg.shape).expand_as(output)
+        loss = self.alpha * self.loss_fn(X_jpeg, X_nat) + T * self.loss_fn(output, reference)
+        return loss, output, reference
+
+    def _coefficient_index(self, y, y_nat, cb, cr, X_nat, c_trg, gen_noattack, T):
+        """
+        (B, blocks, mask_k) flat indices of the Y coefficients the attack optimizes.
+        """
+        B, blocks = y.shape[:2]
+        if self.coefficient_mask == 'zigzag':
+            band = torch.tensor([i * 8 + j for i, j in zigzag(self.mask_k)], device=y.device)
+            return band.expand(B, blocks, -1)
+        if self.coefficient_mask == 'importance':
+            score = y_nat.abs()
+        elif self.coefficient_mask == 'gradient':
+            probe = y.detach().requires_grad_(True)
+            loss, _, _ = self._objective(self.decompress(probe, cb, cr), X_nat, c_trg, T, gen_noattack)
+            score = input_grad(loss, probe, self.scaler).abs()
+        else:
+            raise ValueError('Unknown coefficient mask {}.'.format(self.coefficient_mask))
+        return score.flatten(2).topk(self.mask_k, dim=2)[1]
+
+    def _partial_decoder(self, y, cb, cr, index):
+        """
+        Decoder of the coefficients at index alone: the image of y is decoded once (before
+        the final clamp to [0, 255]), and a step only adds the inverse DCT of the change of
+        the kept coefficients. Luma reaches R, G and B alike, and up to the clamp the
+        result is exactly self.decompress of the full coefficients.
+        """
+        d = self.decompress
+        B, blocks = y.shape[:2]
+        with torch.no_grad():
+            pixels = [d.merging(d.idct(d.y_dequantize(y)), d.height, d.width)]
+            for c in (cb, cr):
+                pixels.append(d.merging(d.idct(d.c_dequantize(c)), d.height // 2, d.width // 2))
+            base = d.colors(d.chroma(*pixels))
+
+            # Dequantized 8x8 pixel pattern of every kept coefficient, (B, blocks, mask_k, 64)
+            unit = torch.eye(64, device=y.device).view(64, 8, 8)
+            basis = (d.idct(d.y_dequantize(unit)) - d.idct(torch.zeros_like(unit[:1]))).view(64, 64)
+            patterns = basis[index]
+        theta_ref = y.flatten(2).gather(2, index)
+
+        def decode(theta):
+            delta = torch.matmul((theta - theta_ref).unsqueeze(2), patterns).view(B, blocks, 8, 8)
+            delta = d.merging(delta, d.height, d.width).unsqueeze(1)
+            return (base + delta).clamp(0, 255) / 255
+
+        return decode
+
+    def load_warm_start(self, path, domain='pixel'):
+        """
+        Warm-start the attacks from a saved universal perturbation, e.g. the
+        universal_perturbation_path of setting.json (a pixel-domain perturbation).
+        """
+        self.warm_start = torch.load(path, map_location=lambda storage, loc: storage).to(self.device)
+        self.warm_start_domain = domain
+
+    def _warm_start(self, X_nat, y_nat):
+        """
+        Starting coefficients from the universal perturbation, projected like a step onto
+        [round(y_nat), round(y_nat) + 1] for every sample.
+        """
+        with torch.no_grad():
+            if self.warm_start_domain == 'pixel':
+                # A [-1, 1] perturbation is half as large on [0, 1] images
+                X = (X_nat + self.warm_start.to(X_nat.device) / 2).clamp_(0, 1)
+                y, _, _ = self.compress(X)
+            else:
+                y = y_nat + self.warm_start.to(y_nat.device)
+        lower = torch.round(y_nat)
+        return clip_tensor_(y.expand_as(y_nat).clone(), lower, lower + 1)
+
+    def _eot(self, X_jpeg):
+        """
+        JPEG round trip of X_jpeg at the sampled EoT qualities and grid offsets, stacked
+        quality-major, then offset-major into one batch. Without EoT this is X_jpeg itself.
+        """
+        if self.eot_qualities is None and self.eot_shifts is None:
+            return X_jpeg
+
+        qualities = torch.tensor(self.eot_qualities or [self.quality], dtype=torch.float32, device=X_jpeg.device)
+        if self.eot_samples is not None and self.eot_samples < len(qualities):
+            qualities = qualities[torch.randperm(len(qualities), device=X_jpeg.device)[:self.eot_samples]]
+
+        shifts = [(0, 0)]
+        if self.eot_shifts is not None:
+            offsets = torch.randperm(64)[:self.eot_shifts].tolist()
+            shifts = [(o % 8, o // 8) for o in offsets]
+        X_shift = X_jpeg if shifts == [(0, 0)] else torch.cat([grid_shift(X_jpeg, dx, dy) for dx, dy in shifts])
+
+        B = X_shift.size(0)
+        self.jpeg.set_quality(qualities.repeat_interleave(B))
+        X_eot = self.jpeg(X_shift.repeat(len(qualities), 1, 1, 1))
+        if shifts == [(0, 0)]:
+            return X_eot
+
+        # Back onto the pixel grid of X_jpeg
+        X_eot = X_eot.view(len(qualities), len(shifts), *X_jpeg.shape)
+        return torch.stack([grid_shift(X_eot[:, s], -dx, -dy) for s, (dx, dy) in enumerate(shifts)], dim=1).flatten(0, 2)
+
+    def _step(self, y, grad):
+        """
+        Per-sample L1-normalized momentum, signed step, then projection of every
+        coefficient onto [round(y), round(y) + 1].
+        """
+        y = y.detach()
+        l1 = grad.abs().sum(dim=tuple(range(1, grad.dim())), keepdim=True).clamp_(min=1e-12)
+        grad = grad.div_(l1)
+        if self.g is None:
+            self.g = grad
+        else:
+            self.g.mul_(self.momentum).add_(grad)
+
+        lower = torch.round(y)
+        y.add_(self.g.sign(), alpha=self.a)
+        clip_tensor_(y, lower, lower + 1)
+        return y
+
+def grid_shift(X, dx, dy):
+    """
+    X cropped by dx columns and dy rows at the top-left (so the JPEG 8x8 grid moves by
+    (dx, dy)) and replicate-padded back to its size at the bottom-right; negative offsets
+    undo it. Works on any (..., H, W) batch.
+    """
+    if dx == 0 and dy == 0:
+        return X
+    H, W = X.shape[-2:]
+    shape = X.shape
+    X = X.reshape(-1, *shape[-3:])
+    if dx >= 0 and dy >= 0:
+        X = F.pad(X[..., dy:, dx:], (0, dx, 0, dy), mode='replicate')
+    else:
+        X = F.pad(X[..., :H + dy, :W + dx], (-dx, 0, -dy, 0), mode='replicate')
+    return X.reshape(shape)
 
 def perturb_batch(X, y, c_trg, model, adversary):
     # Perturb batch function for adversarial training
-    model_cp = copy.deepcopy(model)
-    for p in model_cp.parameters():
-        p.requires_grad = False
-    model_cp.eval()
-    
-    adversary.model = model_cp
+    # The attack runs inside frozen_model(), so the live model can be used without a copy
+    adversary.model = model
 
     X_adv, _ = adversary.perturb(X, y, c_trg)
 
@@ -0,0 +1,64 @@
+import torch
+import torch.nn.functional as F
+
+try:
+    from DiffJPEG.modules.decompression import idct_8x8
+except ImportError:
+    # DiffJPEG lives at the repository root, it has to be importable to build the basis
+    idct_8x8 = None
+
+
+def zigzag(n):
+    """(row, column) of the first n coefficients of an 8x8 block, in JPEG zigzag order."""
+    order = sorted(((i, j) for i in range(8) for j in range(8)),
+                   key=lambda p: (p[0] + p[1], p[1] if (p[0] + p[1]) % 2 == 0 else p[0]))
+    return order[:n]
+
+
+class DCTPerturbation(object):
+    def __init__(self, epsilon, grid=64, coefficients=10, channels=3, device=None):
+        """
+        Universal perturbation held as the first `coefficients` zigzag DCT coefficients of
+        every 8x8 block of a grid x grid image, expanded on the fly: inverse DCT of the
+        blocks, bilinear resize to the resolution of the batch and clip to [-epsilon, epsilon].
+        With the defaults that is 3 x 64 x 10 numbers (7.5 KB) instead of 3 x 256 x 256.
+        """
+        self.epsilon = epsilon
+        self.grid = grid
+        self.coefficients = coefficients
+        self.device = device
+
+        # (coefficients, 64) pixel patterns of the kept coefficients, through the JPEG inverse DCT
+        unit = torch.zeros(coefficients, 8, 8)
+        for k, (i, j) in enumerate(zigzag(coefficients)):
+            unit[k, i, j] = 1
+        idct = idct_8x8()
+        with torch.no_grad():
+            self.basis = (idct(unit) - idct(torch.zeros(1, 8, 8))).view(coefficients, 64).to(device)
+
+        self.coef = torch.zeros(channels, (grid // 8) ** 2, coefficients, device=device)
+
+    def expand(self, size):
+        """The (1, C, H, W) perturbation at resolution size = (H, W)."""
+        C, blocks = self.coef.shape[:2]
+        side = self.grid // 8
+        patches = torch.matmul(self.coef, self.basis).view(C, side, side, 8, 8)
+        up = patches.permute(0, 1, 3, 2, 4).reshape(1, C, self.grid, self.grid)
+        if tuple(size) != (self.grid, self.grid):
+            up = F.interpolate(up, size=tuple(size), mode='bilinear', align_corners=False)
+        return up.clamp(-self.epsilon, self.epsilon)
+
+    def apply(self, X):
+        """Perturbed [-1, 1] images, for a batch at any resolution."""
+        return (X + self.expand(X.shape[-2:])).clamp(-1, 1)
+
+    def state_dict(self):
+        return {'coef': self.coef.cpu(), 'epsilon': self.epsilon, 'grid': self.grid}
+
+    @classmethod
+    def load(cls, path, device=None):
+        state = torch.load(path, map_location=lambda storage, loc: storage)
+        channels, _, coefficients = state['coef'].shape
+        perturbation = cls(state['epsilon'], state['grid'], coefficients, channels, device)
+        perturbation.coef = state['coef'].to(device)
+        return perturbation
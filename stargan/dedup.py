@@ -0,0 +1,196 @@
+import hashlib
+import itertools
+import json
+import os
+from os.path import join
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def dct_basis():
+    """
+    (8, 8, 8, 8) basis and (8, 8) scale of the JPEG 8x8 DCT, as DiffJPEG's dct_8x8 computes
+    it, so the hashes do not depend on DiffJPEG being importable (e.g. from stargan/).
+    """
+    basis = np.zeros((8, 8, 8, 8), dtype=np.float32)
+    for x, y, u, v in itertools.product(range(8), repeat=4):
+        basis[x, y, u, v] = np.cos((2 * x + 1) * u * np.pi / 16) * np.cos((2 * y + 1) * v * np.pi / 16)
+    alpha = np.array([1. / np.sqrt(2)] + [1] * 7)
+    return torch.from_numpy(basis), torch.from_numpy(np.outer(alpha, alpha) * 0.25).float()
+
+
+class DedupIndex(object):
+    def __init__(self, index_dir=None, threshold=8, device='cpu'):
+        """
+        Perceptual-hash index of protected images and their perturbations, so duplicated
+        images are not attacked from scratch again.
+        The hash of an image is the sign against their median of the 63 AC coefficients of
+        the 8x8 DCT of its 8x8 area-downsampled luma, so resized copies and recompressed
+        re-uploads hash alike.
+        Exact duplicates (same 8-bit pixels) reuse the stored perturbation, near-duplicates
+        (Hamming distance <= threshold) start their attack from it.
+        Perturbations are on [-1, 1] images and stored per key, e.g. the target label.
+        index_dir: persisted there (index.json and one float16 file per perturbation) when given.
+            Only one process should write to a given index_dir at a time.
+        """
+        self.index_dir = index_dir
+        self.threshold = threshold
+        self.device = device
+        self.basis, self.scale = [t.to(device) for t in dct_basis()]
+
+        self.entries = []
+        # (digest, key) -> entry, for the exact duplicates
+        self.exact = {}
+        # key -> (entries, (N, 63) bool hashes), for the near-duplicates
+        self.groups = {}
+        self.memory = {}
+        if index_dir is not None:
+            os.makedirs(index_dir, exist_ok=True)
+            self._load_index()
+
+    @staticmethod
+    def key(c):
+        return ','.join('{:g}'.format(v) for v in c.tolist())
+
+    def __len__(self):
+        return len(self.entries)
+
+    def hash(self, X):
+        """
+        Content digests and perceptual hashes of a batch of [-1, 1] images, computed as one batch.
+        Returns a list of hex digests and a (B, 63) bool tensor.
+        """
+        with torch.no_grad():
+            pixels = ((X.detach().clamp(-1, 1) + 1) * 127.5).round_().to(torch.uint8)
+            digests = [hashlib.sha1(str(tuple(p.shape)).encode() + p.cpu().numpy().tobytes()).hexdigest()
+                       for p in pixels]
+
+            # Same luma as the JPEG transform, on [0, 255]
+            luma = torch.tensordot(pixels.float().permute(0, 2, 3, 1),
+                                   torch.tensor([0.299, 0.587, 0.114], device=pixels.device), dims=1)
+            luma = F.adaptive_avg_pool2d(luma.unsqueeze(1), 8).to(self.device)
+            coefficients = (self.scale * torch.tensordot(luma - 128, self.basis, dims=2)).flatten(1)[:, 1:]
+            bits = coefficients > coefficients.median(dim=1, keepdim=True)[0]
+        return digests, bits
+
+    def lookup(self, digests, bits, keys):
+        """
+        For every sample (entry, True) for an exact duplicate, (entry, False) for the closest
+        near-duplicate, or None.
+        """
+        matches = [None] * len(keys)
+        for key in set(keys):
+            samples = [b for b, k in enumerate(keys) if k == key]
+            group = self.groups.get(key)
+            distances = None
+            if group is not None:
+                # Hamming distances of the samples to every hash of the key, in one go
+                distances = (bits[samples].unsqueeze(1) != group[1].unsqueeze(0)).sum(dim=2)
+                distance, nearest = distances.min(dim=1)
+            for j, b in enumerate(samples):
+                entry = self.exact.get((digests[b], key))
+                if entry is not None:
+                    matches[b] = (entry, True)
+                elif distances is not None and distance[j] <= self.threshold:
+                    matches[b] = (group[0][nearest[j]], False)
+        return matches
+
+    def perturbation(self, entry, shape):
+        """Stored perturbation of an entry, resized to the (C, H, W) shape when needed."""
+        if entry in self.memory:
+            delta = self.memory[entry]
+        else:
+            delta = torch.load(join(self.index_dir, self.entries[entry]['file']),
+                               map_location=lambda storage, loc: storage)
+        delta = delta.float().to(self.device)
+        if tuple(delta.shape[1:]) != tuple(shape[1:]):
+            delta = F.interpolate(delta.unsqueeze(0), size=tuple(shape[1:]), mode='bilinear',
+                                  align_corners=False).squeeze(0)
+        return delta
+
+    def add(self, digests, bits, keys, delta):
+        """Store the perturbations of the samples that are not exact duplicates yet."""
+        for b, (digest, key) in enumerate(zip(digests, keys)):
+            if (digest, key) in self.exact:
+                continue
+            entry = len(self.entries)
+            record = {'digest': digest, 'key': key, 'hash': ''.join('1' if v else '0' for v in bits[b].tolist())}
+            stored = delta[b].detach().to(torch.float16).cpu()
+            if self.index_dir is not None:
+                record['file'] = '{}.pt'.format(entry)
+                torch.save(stored, join(self.index_dir, record['file']))
+            else:
+                self.memory[entry] = stored
+            self._insert(record, bits[b].to(self.device))
+        if self.index_dir is not None:
+            self._save_index()
+
+    def protect(self, attack, X_nat, keys, perturb):
+        """
+        Perturbations of a batch of [-1, 1] images, attacking only what the index cannot serve.
+        keys: one key per sample, e.g. DedupIndex.key(c_trg[b])
+        perturb(idx): runs the attack on the samples idx of the batch (a list) and returns
+            their perturbation on [-1, 1] images. Near-duplicates are run on their own, with
+            attack.warm_start set to the perturbations they matched (in the pixel domain).
+        Returns the (B, C, H, W) perturbations, also added to the index.
+        """
+        digests, bits = self.hash(X_nat)
+        matches = self.lookup(digests, bits, keys)
+        delta = torch.zeros_like(X_nat)
+
+        near, fresh = [], []
+        for b, match in enumerate(matches):
+            if match is None:
+                fresh.append(b)
+            elif match[1]:
+                delta[b] = self.perturbation(match[0], X_nat.shape[1:]).to(X_nat.device)
+            else:
+                near.append(b)
+
+        warm_start = attack.warm_start
+        domain = getattr(attack, 'warm_start_domain', None)
+        try:
+            if near:
+                attack.warm_start = torch.stack([self.perturbation(matches[b][0], X_nat.shape[1:])
+                                                 for b in near]).to(X_nat.device)
+                if domain is not None:
+                    attack.warm_start_domain = 'pixel'
+                delta[near] = perturb(near).detach()
+            attack.warm_start = warm_start
+            if domain is not None:
+                attack.warm_start_domain = domain
+            if fresh:
+                delta[fresh] = perturb(fresh).detach()
+        finally:
+            attack.warm_start = warm_start
+            if domain is not None:
+                attack.warm_start_domain = domain
+
+        self.add(digests, bits, keys, delta)
+        return delta
+
+    def _insert(self, record, bits):
+        entry = len(self.entries)
+        self.entries.append(record)
+        self.exact[(record['digest'], record['key'])] = entry
+        entries, hashes = self.groups.get(record['key'], ([], bits.new_zeros(0, bits.numel())))
+        self.groups[record['key']] = (entries + [entry], torch.cat([hashes, bits.unsqueeze(0)]))
+
+    def _load_index(self):
+        path = join(self.index_dir, 'index.json')
+        if not os.path.exists(path):
+            return
+        with open(path, 'r') as f:
+            records = json.load(f)
+        for record in records:
+            bits = torch.from_numpy(np.array([c == '1' for c in record['hash']])).to(self.device)
+            self._insert(record, bits)
+
+    def _save_index(self):
+        path = join(self.index_dir, 'index.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.entries, f)
+        # Atomic, the index only lists perturbations already written
+        os.replace(path + '.tmp', path)
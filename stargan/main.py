@@ -60,6 +60,16 @@ def main(config):
             # solver.test_attack_feats()
             # Conditional attack experiment
             # solver.test_attack_cond()
+            # Mixed-precision vs fp32 attack comparison
+            # solver.test_attack_amp('bf16')
+            # Coarse-to-fine vs single-scale attack comparison
+            # solver.test_attack_multiscale()
+            # Allocator traffic of the attack loop
+            # solver.test_attack_allocations()
+            # Per-image minimal epsilon search
+            # solver.test_attack_epsilon_search()
+            # Attack under a per-batch time budget
+            # solver.test_attack_deadline(budget=1.0)
         elif config.dataset in ['Both']:
             solver.test_multi()
 
@@ -111,6 +121,12 @@ if __name__ == '__main__':
     parser.add_argument('--model_save_dir', type=str, default='stargan/models')
     parser.add_argument('--sample_dir', type=str, default='stargan/samples')
     parser.add_argument('--result_dir', type=str, default='stargan/results')
+    parser.add_argument('--ref_cache_dir', type=str, default=None, help='on-disk cache of clean generator outputs')
+    parser.add_argument('--telemetry_path', type=str, default=None, help='per-step attack log, .jsonl or binary')
+    parser.add_argument('--universal_perturbation_path', type=str, default=None,
+                        help='warm-start the per-image attacks from this universal perturbation')
+    parser.add_argument('--dedup_dir', type=str, default=None,
+                        help='perceptual-hash index of protected images, duplicates reuse their perturbation')
 
     # Step size.
     parser.add_argument('--log_step', type=int, default=10)
@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 import numpy as np
 import sys
 
@@ -57,7 +58,17 @@ class Generator(nn.Module):
         layers.append(nn.Tanh())
         self.main = nn.Sequential(*layers)
 
-    def forward(self, x, c):
+        # Gradient checkpointing of self.main in this many segments (0 disables it), see _sequential
+        self.checkpoint_segments = 0
+
+    def forward(self, x, c, feat_layers=None):
+        """Translate x to domain c.
+
+        feat_layers: optional collection of indices into self.main. When given, the
+        intermediate maps at those indices are returned as well, as a dict keyed by
+        index. By default only the output image is returned so that no activations
+        are kept alive beyond what autograd itself needs.
+        """
         # Replicate spatially and concatenate domain information.
         # Note that this type of label conditioning does not work at all if we use reflection padding in Conv2d.
         # This is because instance normalization ignores the shifting (or bias) effect.
@@ -65,31 +76,68 @@ class Generator(nn.Module):
         c = c.repeat(1, 1, x.size(2), x.size(3))
         x = torch.cat([x, c], dim=1)
 
-        feature_maps = []
-
-        # Get intermediate feature maps
-        for layer in self.main:
-            # print('test')
-            x = layer(x)
-            feature_maps.append(x)
-        # print(len(feature_maps))
-
-        return x, feature_maps
+        return self._run_main(x, feat_layers)
 
-    def forward_blur(self, x, c, blur_layer):
+    def forward_blur(self, x, c, blur_layer, feat_layers=None):
         c = c.view(c.size(0), c.size(1), 1, 1)
         c = c.repeat(1, 1, x.size(2), x.size(3))
         x = blur_layer(x)
         x = torch.cat([x, c], dim=1)
 
-        feature_maps = []
-        # Get intermediate feature maps
-        for layer in self.main:
+        return self._run_main(x, feat_layers)
+
+    def _run_main(self, x, feat_layers):
+        if feat_layers is None:
+            return self._sequential(self.main, x)
+
+        feat_layers = set(feat_layers)
+        feature_maps = {}
+        # Get the requested intermediate feature maps
+        for layer_idx, layer in enumerate(self.main):
             x = layer(x)
-            feature_maps.append(x)
+            if layer_idx in feat_layers:
+                # The in-place ReLU after a norm layer would overwrite the captured map,
+                # forward_to returns it before the activation
+                feature_maps[layer_idx] = x.clone()
 
         return x, feature_maps
 
+    def forward_to(self, x, c, layer, blur_layer=None):
+        """Run self.main only up to (and including) index `layer` and return that activation.
+
+        Feature-level attacks only need one intermediate map, so the remaining layers
+        are neither computed nor kept around for the backward pass.
+        """
+        c = c.view(c.size(0), c.size(1), 1, 1)
+        c = c.repeat(1, 1, x.size(2), x.size(3))
+        if blur_layer is not None:
+            x = blur_layer(x)
+        x = torch.cat([x, c], dim=1)
+
+        return self._sequential(self.main[:layer + 1], x)
+
+    def _sequential(self, layers, x):
+        """Run `layers` on x.
+
+        With checkpoint_segments set and autograd recording, only the segment boundaries are
+        kept for the backward pass and each segment is recomputed there: about one extra
+        forward for O(sqrt(L)) activation memory when segments ~ sqrt(len(layers)).
+        """
+        if not self.checkpoint_segments or not torch.is_grad_enabled():
+            return layers(x)
+
+        size = -(-len(layers) // self.checkpoint_segments)
+        start = 0
+        while start < len(layers):
+            end = min(start + size, len(layers))
+            # A segment must not start with an in-place ReLU, it would overwrite the
+            # input the segment is recomputed from
+            while end < len(layers) and getattr(layers[end], 'inplace', False):
+                end += 1
+            x = checkpoint(layers[start:end], x, use_reentrant=False)
+            start = end
+        return x
+
 class Discriminator(nn.Module):
     """Discriminator network with PatchGAN."""
     def __init__(self, image_size=128, conv_dim=64, c_dim=5, repeat_num=6):
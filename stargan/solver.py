@@ -12,11 +12,17 @@ try:
     from model import Discriminator
     import defenses.smoothing as smoothing
     import attacks
+    from refcache import ReferenceCache, checkpoint_hash
+    from telemetry import AttackTelemetry
+    from dedup import DedupIndex
 except:
     from .model import Generator, AvgBlurGenerator
     from .model import Discriminator
     import stargan.defenses.smoothing as smoothing
     import stargan.attacks as attacks
+    from stargan.refcache import ReferenceCache, checkpoint_hash
+    from stargan.telemetry import AttackTelemetry
+    from stargan.dedup import DedupIndex
 
 from PIL import ImageFilter
 from PIL import Image
@@ -65,6 +71,7 @@ class Solver(object):
 
         # Test configurations.
         self.test_iters = config.test_iters
+        self.mode = config.mode
 
         # Miscellaneous.
         self.use_tensorboard = config.use_tensorboard
@@ -75,6 +82,15 @@ class Solver(object):
         self.sample_dir = config.sample_dir
         self.model_save_dir = config.model_save_dir
         self.result_dir = config.result_dir
+        # Clean reference outputs are cached on disk here when set
+        self.ref_cache_dir = getattr(config, 'ref_cache_dir', None)
+        self.ref_cache = None
+        # Per-step attack convergence log (.jsonl or binary) when set
+        self.telemetry_path = getattr(config, 'telemetry_path', None)
+        # Per-image attacks start from this universal perturbation when set
+        self.universal_perturbation_path = getattr(config, 'universal_perturbation_path', None)
+        # Perceptual-hash index of the protected images, duplicates are not attacked again
+        self.dedup_dir = getattr(config, 'dedup_dir', None)
 
         # Step size.
         self.log_step = config.log_step
@@ -124,6 +140,18 @@ class Solver(object):
         self.load_model_weights(self.G, G_path)
 #        self.D.load_state_dict(torch.load(D_path, map_location=lambda storage, loc: storage))
 
+        # Clean outputs of this checkpoint, the image ids only hold within a resolution and split
+        self.ref_cache = ReferenceCache(self.G, checkpoint_hash(G_path), self.ref_cache_dir,
+                                        namespace='{}-{}'.format(self.image_size, self.mode))
+
+    def clean_output(self, x_real, c_trg, i):
+        """G(x_real, c_trg) for batch i of the test loader, from the reference cache once a checkpoint is restored."""
+        if self.ref_cache is None:
+            with torch.no_grad():
+                return self.G(x_real, c_trg)
+        image_ids = ['{}-{}'.format(self.dataset, i * self.batch_size + b) for b in range(x_real.size(0))]
+        return self.ref_cache(x_real, c_trg, image_ids)
+
     def build_and_restore_alt_model(self):
         """Create a generator and a discriminator."""
         if self.dataset in ['CelebA', 'RaFD']:
@@ -305,7 +333,7 @@ class Solver(object):
             d_loss_cls = self.classification_loss(out_cls, label_org, self.dataset)
 
             # Compute loss with fake images.
-            x_fake, _ = self.G(x_real, c_trg)  # No Attack
+            x_fake = self.G(x_real, c_trg)  # No Attack
             out_src, out_cls = self.D(x_fake.detach())  # No Attack
             d_loss_fake = torch.mean(out_src)
 
@@ -333,13 +361,13 @@ class Solver(object):
             # =================================================================================== #
 
             if (i + 1) % self.n_critic == 0:
-                x_fake, _ = self.G(x_real, c_trg)  # No Attack
+                x_fake = self.G(x_real, c_trg)  # No Attack
                 out_src, out_cls = self.D(x_fake)
                 g_loss_fake = - torch.mean(out_src)
                 g_loss_cls = self.classification_loss(out_cls, label_trg, self.dataset)
 
                 # Target-to-original domain.
-                x_reconst, _ = self.G(x_fake, c_org)  # No Attack
+                x_reconst = self.G(x_fake, c_org)  # No Attack
                 g_loss_rec = torch.mean(torch.abs(x_real - x_reconst))
 
                 # Backward and optimize.
@@ -375,7 +403,7 @@ class Solver(object):
                 with torch.no_grad():
                     x_fake_list = [x_fixed]
                     for c_fixed in c_fixed_list:
-                        elt, _ = self.G(x_fixed, c_fixed)
+                        elt = self.G(x_fixed, c_fixed)
                         x_fake_list.append(elt)
                     x_concat = torch.cat(x_fake_list, dim=3)
                     sample_path = os.path.join(self.sample_dir, '{}-images.jpg'.format(i + 1))
@@ -465,7 +493,7 @@ class Solver(object):
             d_loss_cls = self.classification_loss(out_cls, label_org, self.dataset)
 
             # Compute loss with fake images.
-            x_fake, _ = self.G(x_real, c_trg)  # No Attack
+            x_fake = self.G(x_real, c_trg)  # No Attack
             out_src, out_cls = self.D(x_fake.detach())  # No Attack
             d_loss_fake = torch.mean(out_src)
 
@@ -501,14 +529,14 @@ class Solver(object):
                 pgd_attack = attacks.LinfPGDAttack(model=self.G, device=self.device, feat=None)
                 x_real_adv = attacks.perturb_batch(x_real, black, c_trg, self.G, pgd_attack)
 
-                x_fake, _ = self.G(x_real_adv, c_trg)  # Attack
+                x_fake = self.G(x_real_adv, c_trg)  # Attack
                 out_src, out_cls = self.D(x_fake)
                 g_loss_fake = - torch.mean(out_src)
                 g_loss_cls = self.classification_loss(out_cls, label_trg, self.dataset)
 
                 # Target-to-original domain.
                 x_fake_adv = attacks.perturb_batch(x_fake, black, c_org, self.G, pgd_attack)
-                x_reconst, _ = self.G(x_fake_adv, c_org)  # Attack
+                x_reconst = self.G(x_fake_adv, c_org)  # Attack
                 g_loss_rec = torch.mean(torch.abs(x_real - x_reconst))
 
                 # Backward and optimize.
@@ -544,7 +572,7 @@ class Solver(object):
                 with torch.no_grad():
                     x_fake_list = [x_fixed]
                     for c_fixed in c_fixed_list:
-                        elt, _ = self.G(x_fixed, c_fixed)
+                        elt = self.G(x_fixed, c_fixed)
                         x_fake_list.append(elt)
                     x_concat = torch.cat(x_fake_list, dim=3)
                     sample_path = os.path.join(self.sample_dir, '{}-images.jpg'.format(i + 1))
@@ -640,7 +668,7 @@ class Solver(object):
             d_loss_cls = self.classification_loss(out_cls, label_org, self.dataset)
 
             # Compute loss with fake images.
-            x_fake, _ = self.G(x_real_adv, c_trg)  # Attack
+            x_fake = self.G(x_real_adv, c_trg)  # Attack
             x_fake_adv = attacks.perturb_batch(x_fake, black, c_org, self.G, pgd_attack)  # Adversarial training
             out_src, out_cls = self.D(x_fake_adv.detach())  # Attack
             d_loss_fake = torch.mean(out_src)
@@ -670,14 +698,14 @@ class Solver(object):
 
             if (i + 1) % self.n_critic == 0:
                 # Original-to-target domain
-                x_fake, _ = self.G(x_real_adv, c_trg)  # Attack
+                x_fake = self.G(x_real_adv, c_trg)  # Attack
                 out_src, out_cls = self.D(x_fake)
                 g_loss_fake = - torch.mean(out_src)
                 g_loss_cls = self.classification_loss(out_cls, label_trg, self.dataset)
 
                 # Target-to-original domain.
                 x_fake_adv = attacks.perturb_batch(x_fake, black, c_org, self.G, pgd_attack)
-                x_reconst, _ = self.G(x_fake_adv, c_org)  # Attack
+                x_reconst = self.G(x_fake_adv, c_org)  # Attack
                 g_loss_rec = torch.mean(torch.abs(x_real - x_reconst))
 
                 # Backward and optimize.
@@ -713,7 +741,7 @@ class Solver(object):
                 with torch.no_grad():
                     x_fake_list = [x_fixed]
                     for c_fixed in c_fixed_list:
-                        elt, _ = self.G(x_fixed, c_fixed)
+                        elt = self.G(x_fixed, c_fixed)
                         x_fake_list.append(elt)
                     x_concat = torch.cat(x_fake_list, dim=3)
                     sample_path = os.path.join(self.sample_dir, '{}-images.jpg'.format(i + 1))
@@ -961,6 +989,11 @@ class Solver(object):
         # Initialize Metrics
         l1_error, l2_error, min_dist, l0_error = 0.0, 0.0, 0.0, 0.0
         n_dist, n_samples = 0, 0
+        telemetry = AttackTelemetry(self.telemetry_path) if self.telemetry_path else None
+        warm_start = None
+        if self.universal_perturbation_path:
+            warm_start = torch.load(self.universal_perturbation_path, map_location=lambda storage, loc: storage).to(self.device)
+        dedup = DedupIndex(self.dedup_dir, device=self.device) if self.dedup_dir else None
 
         for i, (x_real, c_org) in enumerate(data_loader):
             # Prepare input images and target domain labels.
@@ -968,18 +1001,25 @@ class Solver(object):
             c_trg_list = self.create_labels(c_org, self.c_dim, self.dataset, self.selected_attrs)
 
             pgd_attack = attacks.LinfPGDAttack(model=self.G, device=self.device, feat=None)
+            pgd_attack.telemetry = telemetry
+            pgd_attack.warm_start = warm_start
 
             # Translated images.
             x_fake_list = [x_real]
 
             for idx, c_trg in enumerate(c_trg_list):
-                with torch.no_grad():
-                    x_real_mod = x_real
-                    # x_real_mod = self.blur_tensor(x_real_mod) # use blur
-                    gen_noattack, gen_noattack_feats = self.G(x_real_mod, c_trg)
+                x_real_mod = x_real
+                # x_real_mod = self.blur_tensor(x_real_mod) # use blur
+                gen_noattack = self.clean_output(x_real_mod, c_trg, i)
 
                 # Attacks
-                x_adv, perturb = pgd_attack.perturb(x_real, gen_noattack, c_trg)  # Vanilla attack
+                if dedup is not None:
+                    # Vanilla attack, only on the images the index has no perturbation for
+                    keys = [DedupIndex.key(c) for c in c_trg]
+                    perturb = dedup.protect(pgd_attack, x_real, keys,
+                                            lambda idx: pgd_attack.perturb(x_real[idx], gen_noattack[idx], c_trg[idx])[1])
+                else:
+                    x_adv, perturb = pgd_attack.perturb(x_real, gen_noattack, c_trg)  # Vanilla attack
                 # x_adv, perturb, blurred_image = pgd_attack.perturb_blur(x_real, gen_noattack, c_trg)    # White-box attack on blur
                 # x_adv, perturb = pgd_attack.perturb_blur_iter_full(x_real, gen_noattack, c_trg)         # Spread-spectrum attack on blur
                 # x_adv, perturb = pgd_attack.perturb_blur_eot(x_real, gen_noattack, c_trg)               # EoT blur adaptation
@@ -994,7 +1034,7 @@ class Solver(object):
 
                 # Metrics
                 with torch.no_grad():
-                    gen, _ = self.G(x_adv, c_trg)
+                    gen = self.G(x_adv, c_trg)
 
                     # Add to lists
                     # x_fake_list.append(blurred_image)
@@ -1016,6 +1056,8 @@ class Solver(object):
             save_image(self.denorm(x_concat.data.cpu()), result_path, nrow=1, padding=0)
             if i == 49:  # stop after this many images
                 break
+        if telemetry is not None:
+            telemetry.close()
 
         # Print metrics
         print('{} images. L1 error: {}. L2 error: {}. prop_dist: {}. L0 error: {}. L_-inf error: {}.'.format(n_samples,
@@ -1026,6 +1068,272 @@ class Solver(object):
                                                                                                              l0_error / n_samples,
                                                                                                              min_dist / n_samples))
 
+    def test_attack_amp(self, amp='bf16'):
+        """Compare the vanilla attack in fp32 and in mixed precision (amp: 'bf16' or 'fp16')."""
+
+        # Load the trained generator.
+        self.restore_model(self.test_iters)
+
+        # Set data loader.
+        if self.dataset == 'CelebA':
+            data_loader = self.celeba_loader
+        elif self.dataset == 'RaFD':
+            data_loader = self.rafd_loader
+
+        # Initialize Metrics, one entry per precision
+        modes = [None, amp]
+        l2_error = {mode: 0.0 for mode in modes}
+        n_dist = {mode: 0 for mode in modes}
+        elapsed = {mode: 0.0 for mode in modes}
+        max_diff, n_samples = 0.0, 0
+
+        for i, (x_real, c_org) in enumerate(data_loader):
+            # Prepare input images and target domain labels.
+            x_real = x_real.to(self.device)
+            c_trg_list = self.create_labels(c_org, self.c_dim, self.dataset, self.selected_attrs)
+
+            for idx, c_trg in enumerate(c_trg_list):
+                gen_noattack = self.clean_output(x_real, c_trg, i)
+
+                # Same random start for both precisions
+                seed = np.random.randint(2 ** 31)
+                perturbs = {}
+                for mode in modes:
+                    np.random.seed(seed)
+                    pgd_attack = attacks.LinfPGDAttack(model=self.G, device=self.device, feat=None, amp=mode)
+                    start_time = time.time()
+                    x_adv, perturbs[mode] = pgd_attack.perturb(x_real, gen_noattack, c_trg)
+                    if self.device.type == 'cuda':
+                        torch.cuda.synchronize()
+                    elapsed[mode] += time.time() - start_time
+
+                    # Metrics, always evaluated in fp32
+                    with torch.no_grad():
+                        gen = self.G(x_real + perturbs[mode], c_trg)
+                        l2_error[mode] += F.mse_loss(gen, gen_noattack).item()
+                        if F.mse_loss(gen, gen_noattack) > 0.05:
+                            n_dist[mode] += 1
+
+                max_diff = max(max_diff, (perturbs[amp] - perturbs[None]).abs().max().item())
+                n_samples += 1
+
+            if i == 49:  # stop after this many images
+                break
+
+        # Print metrics
+        for mode in modes:
+            print('{}: {} images. L2 error: {}. prop_dist: {}. Time: {:.2f}s.'.format(mode or 'fp32', n_samples,
+                                                                                   l2_error[mode] / n_samples,
+                                                                                   float(n_dist[mode]) / n_samples,
+                                                                                   elapsed[mode]))
+        print('{} - fp32: L2 error delta: {}. prop_dist delta: {}. Speedup: {:.2f}x. Max perturbation difference: {}.'.format(
+            amp, (l2_error[amp] - l2_error[None]) / n_samples, float(n_dist[amp] - n_dist[None]) / n_samples,
+            elapsed[None] / elapsed[amp], max_diff))
+
+    def test_attack_multiscale(self, schedule=((0.5, 7), (1.0, 3))):
+        """Compare the vanilla attack with its coarse-to-fine schedule (LinfPGDAttack.perturb_multiscale)."""
+
+        # Load the trained generator.
+        self.restore_model(self.test_iters)
+
+        # Set data loader.
+        if self.dataset == 'CelebA':
+            data_loader = self.celeba_loader
+        elif self.dataset == 'RaFD':
+            data_loader = self.rafd_loader
+
+        # Initialize Metrics, one entry per schedule
+        modes = ['single-scale', 'multiscale']
+        l2_error = {mode: 0.0 for mode in modes}
+        n_dist = {mode: 0 for mode in modes}
+        elapsed = {mode: 0.0 for mode in modes}
+        n_samples = 0
+
+        for i, (x_real, c_org) in enumerate(data_loader):
+            # Prepare input images and target domain labels.
+            x_real = x_real.to(self.device)
+            c_trg_list = self.create_labels(c_org, self.c_dim, self.dataset, self.selected_attrs)
+
+            for idx, c_trg in enumerate(c_trg_list):
+                gen_noattack = self.clean_output(x_real, c_trg, i)
+
+                for mode in modes:
+                    pgd_attack = attacks.LinfPGDAttack(model=self.G, device=self.device, feat=None)
+                    start_time = time.time()
+                    if mode == 'multiscale':
+                        x_adv, perturb = pgd_attack.perturb_multiscale(x_real, gen_noattack, c_trg, schedule)
+                    else:
+                        x_adv, perturb = pgd_attack.perturb(x_real, gen_noattack, c_trg)
+                    if self.device.type == 'cuda':
+                        torch.cuda.synchronize()
+                    elapsed[mode] += time.time() - start_time
+
+                    with torch.no_grad():
+                        gen = self.G(x_adv, c_trg)
+                        l2_error[mode] += F.mse_loss(gen, gen_noattack).item()
+                        if F.mse_loss(gen, gen_noattack) > 0.05:
+                            n_dist[mode] += 1
+                n_samples += 1
+
+            if i == 49:  # stop after this many images
+                break
+
+        # Print metrics
+        for mode in modes:
+            print('{}: {} images. L2 error: {}. prop_dist: {}. Time: {:.2f}s.'.format(mode, n_samples,
+                                                                                   l2_error[mode] / n_samples,
+                                                                                   float(n_dist[mode]) / n_samples,
+                                                                                   elapsed[mode]))
+        print('multiscale {} - single-scale: L2 error delta: {}. prop_dist delta: {}. Speedup: {:.2f}x.'.format(
+            schedule, (l2_error['multiscale'] - l2_error['single-scale']) / n_samples,
+            float(n_dist['multiscale'] - n_dist['single-scale']) / n_samples,
+            elapsed['single-scale'] / elapsed['multiscale']))
+
+    def test_attack_allocations(self):
+        """Allocator traffic of the vanilla attack loop, in total and in its update step (LinfPGDAttack._step)."""
+        from torch.profiler import profile, ProfilerActivity
+
+        # Load the trained generator.
+        self.restore_model(self.test_iters)
+
+        # Set data loader.
+        if self.dataset == 'CelebA':
+            data_loader = self.celeba_loader
+        elif self.dataset == 'RaFD':
+            data_loader = self.rafd_loader
+
+        x_real, c_org = next(iter(data_loader))
+        x_real = x_real.to(self.device)
+        c_trg = self.create_labels(c_org, self.c_dim, self.dataset, self.selected_attrs)[0]
+        gen_noattack = self.clean_output(x_real, c_trg, 0)
+
+        pgd_attack = attacks.LinfPGDAttack(model=self.G, device=self.device, feat=None)
+        # Warm up the caching allocator
+        pgd_attack.perturb(x_real, gen_noattack, c_trg)
+
+        activities = [ProfilerActivity.CPU]
+        if self.device.type == 'cuda':
+            activities.append(ProfilerActivity.CUDA)
+            torch.cuda.synchronize()
+            stats = torch.cuda.memory_stats(self.device)
+        with profile(activities=activities, profile_memory=True) as prof:
+            pgd_attack.perturb(x_real, gen_noattack, c_trg)
+
+        def allocated(event):
+            if hasattr(event, 'self_device_memory_usage'):
+                device = event.self_device_memory_usage
+            else:
+                device = event.self_cuda_memory_usage
+            return max(event.self_cpu_memory_usage, 0) + max(device, 0)
+
+        events = prof.events()
+        steps = [e for e in events if e.name == 'LinfPGDAttack._step']
+        in_step = [e for e in events if e.name != 'LinfPGDAttack._step' and
+                   any(s.time_range.start <= e.time_range.start and e.time_range.end <= s.time_range.end for s in steps)]
+        k = len(steps)
+
+        # Print metrics, per iteration
+        print('Attack loop: {:.1f} allocations, {:.1f} KB per iteration.'.format(
+            sum(allocated(e) > 0 for e in events) / k, sum(allocated(e) for e in events) / k / 1024))
+        print('Update step: {:.1f} allocations, {:.1f} KB per iteration.'.format(
+            sum(allocated(e) > 0 for e in in_step) / k, sum(allocated(e) for e in in_step) / k / 1024))
+        if self.device.type == 'cuda':
+            after = torch.cuda.memory_stats(self.device)
+            print('CUDA caching allocator: {} requests, {} new segments (cudaMalloc) during the attack.'.format(
+                after['allocation.all.allocated'] - stats['allocation.all.allocated'],
+                after['segment.all.allocated'] - stats['segment.all.allocated']))
+
+    def test_attack_epsilon_search(self, candidates=4, rounds=3, threshold=0.05):
+        """Per-image minimal epsilon of the vanilla attack (LinfPGDAttack.search_epsilon), saved as an epsilon map."""
+
+        # Load the trained generator.
+        self.restore_model(self.test_iters)
+
+        # Set data loader.
+        if self.dataset == 'CelebA':
+            data_loader = self.celeba_loader
+        elif self.dataset == 'RaFD':
+            data_loader = self.rafd_loader
+
+        # One row per image, one column per target domain
+        epsilon_map = []
+        l2_error, n_dist, n_samples = 0.0, 0, 0
+        start_time = time.time()
+
+        for i, (x_real, c_org) in enumerate(data_loader):
+            # Prepare input images and target domain labels.
+            x_real = x_real.to(self.device)
+            c_trg_list = self.create_labels(c_org, self.c_dim, self.dataset, self.selected_attrs)
+            pgd_attack = attacks.LinfPGDAttack(model=self.G, device=self.device, feat=None)
+
+            epsilons = []
+            for idx, c_trg in enumerate(c_trg_list):
+                gen_noattack = self.clean_output(x_real, c_trg, i)
+                x_adv, epsilon = pgd_attack.search_epsilon(x_real, gen_noattack, c_trg, candidates=candidates,
+                                                           rounds=rounds, threshold=threshold)
+                epsilons.append(epsilon.cpu())
+
+                with torch.no_grad():
+                    gen = self.G(x_adv, c_trg)
+                    l2_error += (gen - gen_noattack).pow(2).flatten(1).mean(dim=1).sum().item()
+                    n_dist += int((epsilon == epsilon).sum())
+                    n_samples += x_real.size(0)
+            epsilon_map.append(torch.stack(epsilons, dim=1))
+
+            if i == 49:  # stop after this many images
+                break
+
+        epsilon_map = torch.cat(epsilon_map).numpy()
+        np.save(os.path.join(self.result_dir, 'epsilon_map.npy'), epsilon_map)
+
+        # Print metrics
+        print('{} images. L2 error: {}. prop_dist: {}. Mean epsilon: {} (global epsilon: {}). Time: {:.2f}s.'.format(
+            n_samples, l2_error / n_samples, float(n_dist) / n_samples, np.nanmean(epsilon_map),
+            pgd_attack.epsilon, time.time() - start_time))
+        print('Epsilon map saved into {}.'.format(os.path.join(self.result_dir, 'epsilon_map.npy')))
+
+    def test_attack_deadline(self, budget=1.0, threshold=0.05):
+        """Vanilla attack under a per-batch time budget in seconds (LinfPGDAttack.perturb_deadline)."""
+
+        # Load the trained generator.
+        self.restore_model(self.test_iters)
+
+        # Set data loader.
+        if self.dataset == 'CelebA':
+            data_loader = self.celeba_loader
+        elif self.dataset == 'RaFD':
+            data_loader = self.rafd_loader
+
+        # Initialize Metrics
+        l2_error, n_dist, n_samples = 0.0, 0, 0
+        latencies = []
+
+        for i, (x_real, c_org) in enumerate(data_loader):
+            # Prepare input images and target domain labels.
+            x_real = x_real.to(self.device)
+            c_trg_list = self.create_labels(c_org, self.c_dim, self.dataset, self.selected_attrs)
+            pgd_attack = attacks.LinfPGDAttack(model=self.G, device=self.device, feat=None)
+
+            for idx, c_trg in enumerate(c_trg_list):
+                gen_noattack = self.clean_output(x_real, c_trg, i)
+
+                start_time = time.time()
+                x_adv, perturb, dist = pgd_attack.perturb_deadline(x_real, gen_noattack, c_trg, budget, threshold)
+                if self.device.type == 'cuda':
+                    torch.cuda.synchronize()
+                latencies.append(time.time() - start_time)
+
+                l2_error += dist.sum().item()
+                n_dist += int((dist > threshold).sum())
+                n_samples += x_real.size(0)
+
+            if i == 49:  # stop after this many images
+                break
+
+        # Print metrics
+        print('{} images, budget {}s. L2 error: {}. prop_dist: {}. Latency: mean {:.3f}s, max {:.3f}s.'.format(
+            n_samples, budget, l2_error / n_samples, float(n_dist) / n_samples, np.mean(latencies), np.max(latencies)))
+
     def test_universal_attack(self):
         """Universal Attack by Huang Hao"""
 
@@ -1055,10 +1363,9 @@ class Solver(object):
 
             for idx, c_trg in enumerate(c_trg_list):
                 # print('image', i, 'class', idx)
-                with torch.no_grad():
-                    x_real_mod = x_real
-                    # x_real_mod = self.blur_tensor(x_real_mod) # use blur
-                    gen_noattack, gen_noattack_feats = self.G(x_real_mod, c_trg)
+                x_real_mod = x_real
+                # x_real_mod = self.blur_tensor(x_real_mod) # use blur
+                gen_noattack = self.clean_output(x_real_mod, c_trg, i)
 
                 # Attacks
                 x_adv, perturb = pgd_attack.universal_perturb(x_real, gen_noattack, c_trg)  # Vanilla attack
@@ -1084,8 +1391,9 @@ class Solver(object):
             x_fake_list = [x_real]
             for idx, c_trg in enumerate(c_trg_list):
                 x_adv = x_real + pgd_attack.up
+                gen_noattack = self.clean_output(x_real, c_trg, i)
                 with torch.no_grad():
-                    gen, _ = self.G(x_adv, c_trg)
+                    gen = self.G(x_adv, c_trg)
 
                     # Add to lists
                     # x_fake_list.append(blurred_image)
@@ -1151,20 +1459,20 @@ class Solver(object):
                 x_fake_list = [x_real]
 
                 for c_trg in c_trg_list:
-                    with torch.no_grad():
-                        gen_noattack, gen_noattack_feats = self.G(x_real, c_trg)
-
                     # Attack
                     if layer_num == None:
+                        gen_noattack = self.clean_output(x_real, c_trg, i)
                         x_adv, perturb = pgd_attack.perturb(x_real, gen_noattack, c_trg)
                     else:
+                        with torch.no_grad():
+                            gen_noattack, gen_noattack_feats = self.G(x_real, c_trg, feat_layers=[layer_num])
                         x_adv, perturb = pgd_attack.perturb(x_real, gen_noattack_feats[layer_num], c_trg)
 
                     x_adv = x_real + perturb
 
                     # Metrics
                     with torch.no_grad():
-                        gen, gen_feats = self.G(x_adv, c_trg)
+                        gen = self.G(x_adv, c_trg)
 
                         # Add to lists
                         x_fake_list.append(x_adv)
@@ -1218,9 +1526,8 @@ class Solver(object):
 
             for idx, c_trg in enumerate(c_trg_list):
                 print(i, idx)
-                with torch.no_grad():
-                    x_real_mod = x_real
-                    gen_noattack, gen_noattack_feats = self.G(x_real_mod, c_trg)
+                x_real_mod = x_real
+                gen_noattack = self.clean_output(x_real_mod, c_trg, i)
 
                 # Transfer to different classes
                 if idx == 0:
@@ -1240,7 +1547,7 @@ class Solver(object):
 
                 # Metrics
                 with torch.no_grad():
-                    gen, _ = self.G(x_adv, c_trg)
+                    gen = self.G(x_adv, c_trg)
 
                     # Add to lists
                     x_fake_list.append(x_adv)
@@ -1322,10 +1629,9 @@ class Solver(object):
 
         for idx, c_trg in enumerate(c_trg_list):
             # print('image', i, 'class', idx)
-            with torch.no_grad():
-                x_real_mod = x_real
-                # x_real_mod = self.blur_tensor(x_real_mod) # use blur
-                gen_noattack, gen_noattack_feats = self.G(x_real_mod, c_trg)
+            x_real_mod = x_real
+            # x_real_mod = self.blur_tensor(x_real_mod) # use blur
+            gen_noattack = self.clean_output(x_real_mod, c_trg, i)
 
             # Attacks
             x_adv, perturb = pgd_attack.universal_perturb_stargan(x_real, gen_noattack, c_trg, self.G)  # Vanilla
@@ -1345,9 +1651,9 @@ class Solver(object):
         x_noattack_list = []
 
         for idx, c_trg in enumerate(c_trg_list):
+            gen_noattack = self.clean_output(x_real, c_trg, i)
             with torch.no_grad():
-                gen_noattack, gen_noattack_feats = self.G(x_real, c_trg)
-                gen, gen_feats = self.G(x_adv, c_trg)
+                gen = self.G(x_adv, c_trg)
                 x_fake_list.append(gen)
                 x_noattack_list.append(gen_noattack)
 
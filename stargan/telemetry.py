@@ -0,0 +1,84 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+
+class AttackTelemetry(object):
+    # Columns of the buffer, per iteration and sample
+    METRICS = ('loss', 'grad_norm', 'perturbation_norm')
+
+    def __init__(self, path):
+        """
+        Convergence curves of attacks, without syncing the attack loop.
+        Every step writes per-sample loss, gradient L2 norm and perturbation L2 norm into a
+        preallocated (k, batch, 3) buffer on the attack's device. After the last step of a
+        batch the buffer is copied to the host and written by a background thread.
+        path: '.jsonl' for one JSON line per batch, anything else for a compact binary log
+            of float32 arrays, see load()
+        Metrics an attack does not compute (e.g. the loss of most variants) are NaN.
+        """
+        self.path = path
+        self.binary = not path.endswith('.jsonl')
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self.buffer = None
+        self.batch = 0
+        self.meta = {}
+
+    def begin(self, steps, batch_size, device, **meta):
+        """Start a batch of `steps` iterations; meta is stored with it in the log."""
+        shape = (steps, batch_size, len(self.METRICS))
+        if self.buffer is None or self.buffer.shape != shape or self.buffer.device != torch.device(device):
+            self.buffer = torch.empty(shape, device=device)
+        self.buffer.fill_(float('nan'))
+        self.meta = meta
+
+    def record(self, i, grad_norm, perturbation_norm, loss=None):
+        """Per-sample values of iteration i, flushed after the last iteration."""
+        if loss is not None:
+            self.buffer[i, :, 0] = loss
+        self.buffer[i, :, 1] = grad_norm
+        self.buffer[i, :, 2] = perturbation_norm
+        if i == self.buffer.size(0) - 1:
+            self.flush()
+
+    def flush(self):
+        pinned = self.buffer.is_cuda
+        host = torch.empty(self.buffer.shape, pin_memory=pinned)
+        host.copy_(self.buffer, non_blocking=pinned)
+        event = None
+        if pinned:
+            event = torch.cuda.Event()
+            event.record()
+        self.pool.submit(self._write, self.batch, host, event, self.meta)
+        self.batch += 1
+
+    def _write(self, batch, host, event, meta):
+        if event is not None:
+            event.synchronize()
+        if self.binary:
+            with open(self.path, 'ab') as f:
+                np.save(f, host.numpy())
+        else:
+            record = dict(meta, batch=batch, metrics=list(self.METRICS), values=host.tolist())
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+    def close(self):
+        """Wait for the pending writes."""
+        self.pool.shutdown(wait=True)
+
+    @staticmethod
+    def load(path):
+        """List of (k, batch, 3) arrays, one per logged batch."""
+        batches = []
+        if path.endswith('.jsonl'):
+            with open(path, 'r') as f:
+                for line in f:
+                    batches.append(np.array(json.loads(line)['values'], dtype=np.float32))
+            return batches
+        with open(path, 'rb') as f:
+            while f.peek(1):
+                batches.append(np.load(f))
+        return batches
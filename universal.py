@@ -0,0 +1,288 @@
+import argparse
+import json
+import os
+from os.path import join
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.utils import data
+
+from data import CelebA
+from stargan.model import Generator
+from stargan.compact import DCTPerturbation
+import stargan.attacks as attacks
+
+
+def parse(args=None):
+    """ load config from the setting.json, plus the trainer options """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--setting', type=str, default='./setting.json')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--checkpoint_every', type=int, default=10, help='rounds between checkpoints')
+    parser.add_argument('--resume_iters', type=int, default=200000, help='StarGAN checkpoint to attack')
+    parser.add_argument('--port', type=int, default=29500)
+    parser.add_argument('--compact', action='store_true', help='train a DCTPerturbation instead of a dense one')
+    parser.add_argument('--grid', type=int, default=64, help='resolution of the compact perturbation')
+    parser.add_argument('--coefficients', type=int, default=10, help='zigzag DCT coefficients kept per 8x8 block')
+    args = parser.parse_args(args)
+    with open(args.setting, 'r') as f:
+        args_attack = json.load(f, object_hook=lambda d: argparse.Namespace(**d))
+    return args, args_attack
+
+
+def create_labels(c_org, c_dim=5, selected_attrs=None):
+    """Generate target domain labels for CelebA."""
+    hair_color_indices = []
+    for i, attr_name in enumerate(selected_attrs):
+        if attr_name in ['Black_Hair', 'Blond_Hair', 'Brown_Hair', 'Gray_Hair']:
+            hair_color_indices.append(i)
+
+    c_trg_list = []
+    for i in range(c_dim):
+        c_trg = c_org.clone()
+        if i in hair_color_indices:  # Set one hair color to 1 and the rest to 0.
+            c_trg[:, i] = 1
+            for j in hair_color_indices:
+                if j != i:
+                    c_trg[:, j] = 0
+        else:
+            c_trg[:, i] = (c_trg[:, i] == 0)  # Reverse attribute value.
+        c_trg_list.append(c_trg)
+    return c_trg_list
+
+
+class RoundSampler(object):
+    """
+    Batches of one worker: round r covers dataset[start + r * world_size * batch_size, ...),
+    and this rank takes its slice of it. Near the end of the dataset a rank may have no
+    batch in a round; has_batch() tells, so every rank can still join the collectives.
+    """
+    def __init__(self, num_samples, batch_size, start=0, rank=0, world_size=1):
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.start = start
+        self.rank = rank
+        self.world_size = world_size
+        self.round_size = batch_size * world_size
+
+    def __iter__(self):
+        for r in range(self.num_rounds()):
+            if self.has_batch(r):
+                begin = self._begin(r)
+                yield list(range(begin, min(begin + self.batch_size, self.num_samples)))
+
+    def __len__(self):
+        return sum(self.has_batch(r) for r in range(self.num_rounds()))
+
+    def num_rounds(self):
+        return (max(self.num_samples - self.start, 0) + self.round_size - 1) // self.round_size
+
+    def has_batch(self, r):
+        return self._begin(r) < self.num_samples
+
+    def _begin(self, r):
+        return self.start + r * self.round_size + self.rank * self.batch_size
+
+
+class UniversalTrainer(object):
+    def __init__(self, attack, dataset, batch_size, checkpoint_path, checkpoint_every=10,
+                 c_dim=5, selected_attrs=None, rank=0, world_size=1, num_workers=1):
+        """
+        Streams the whole dataset through LinfPGDAttack.universal_perturb.
+        Each round every worker updates the shared perturbation on its own batch, then the
+        updates are averaged across workers. The perturbation and the dataset position are
+        checkpointed every `checkpoint_every` rounds, and training resumes from there.
+        """
+        self.attack = attack
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.c_dim = c_dim
+        self.selected_attrs = selected_attrs
+        self.rank = rank
+        self.world_size = world_size
+        self.num_workers = num_workers
+
+        self.position = 0
+        self.round = 0
+
+    @property
+    def up(self):
+        """The trained perturbation, what is averaged across workers and checkpointed."""
+        return self.attack.up
+
+    @up.setter
+    def up(self, up):
+        self.attack.up = up
+
+    def update(self, x_real, gen_noattack, c_trg):
+        """Update the perturbation on one batch and target domain."""
+        self.attack.universal_perturb(x_real, gen_noattack, c_trg)
+
+    def load_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return
+        checkpoint = torch.load(self.checkpoint_path, map_location=lambda storage, loc: storage)
+        self.up = None if checkpoint['up'] is None else checkpoint['up'].to(self.attack.device)
+        self.position = checkpoint['position']
+        self.round = checkpoint['round']
+        print('Resuming the universal perturbation from sample {} (round {})...'.format(self.position, self.round))
+
+    def save_checkpoint(self):
+        if self.rank != 0:
+            return
+        tmp_path = self.checkpoint_path + '.tmp'
+        up = None if self.up is None else self.up.cpu()
+        torch.save({'up': up, 'position': self.position, 'round': self.round}, tmp_path)
+        # Atomic, so an interruption never leaves a half-written checkpoint
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def train(self):
+        self.load_checkpoint()
+
+        num_samples = len(self.dataset)
+        sampler = RoundSampler(num_samples, self.batch_size, self.position, self.rank, self.world_size)
+        data_loader = data.DataLoader(self.dataset, batch_sampler=sampler, num_workers=self.num_workers)
+
+        batches = iter(data_loader)
+        for r in range(sampler.num_rounds()):
+            if sampler.has_batch(r):
+                x_real, _, c_org = next(batches)
+                # The dataset gives [0, 1] images, the generator works on [-1, 1]
+                x_real = (x_real * 2 - 1).to(self.attack.device)
+                for c_trg in create_labels(c_org, self.c_dim, self.selected_attrs):
+                    c_trg = c_trg.to(self.attack.device)
+                    with torch.no_grad(), attacks.frozen_model(self.attack.model):
+                        gen_noattack = self.attack.model(x_real, c_trg)
+                    self.update(x_real, gen_noattack, c_trg)
+
+            if self.world_size > 1:
+                self.up = self.all_reduce(self.up)
+
+            self.position = min(self.position + sampler.round_size, num_samples)
+            self.round += 1
+            if self.round % self.checkpoint_every == 0:
+                self.save_checkpoint()
+                if self.rank == 0:
+                    print('Round {}, {}/{} images.'.format(self.round, self.position, num_samples))
+
+        self.save_checkpoint()
+        return self.up
+
+    def all_reduce(self, up):
+        """Average the perturbation over the workers; a worker with nothing yet contributes nothing."""
+        if up is None:
+            size = self.dataset[0][0].shape
+            up = torch.zeros((1,) + tuple(size), device=self.attack.device)
+            count = torch.zeros(1)
+        else:
+            up = up.clone()
+            count = torch.ones(1)
+        dist.all_reduce(up)
+        dist.all_reduce(count)
+        if count.item() == 0:
+            return None
+        return up / count.item()
+
+
+class CompactUniversalTrainer(UniversalTrainer):
+    def __init__(self, attack, dataset, batch_size, checkpoint_path, grid=64, coefficients=10, **kwargs):
+        """
+        UniversalTrainer of a DCTPerturbation. Every batch takes attack.k signed steps on the
+        DCT coefficients themselves, through the on-the-fly expansion, so the updates, the
+        all-reduce and the checkpoints only touch kilobytes.
+        A coefficient step is 8 * attack.a, which moves a block by attack.a through its DC term.
+        """
+        super(CompactUniversalTrainer, self).__init__(attack, dataset, batch_size, checkpoint_path, **kwargs)
+        self.perturbation = DCTPerturbation(attack.epsilon, grid, coefficients, device=attack.device)
+        if attack.rand:
+            # Random start, the loss has no gradient at the clean images
+            self.perturbation.coef.uniform_(-attack.epsilon, attack.epsilon)
+
+    @property
+    def up(self):
+        return self.perturbation.coef
+
+    @up.setter
+    def up(self, up):
+        self.perturbation.coef = up
+
+    def update(self, x_real, gen_noattack, c_trg):
+        attack = self.attack
+        coef = self.perturbation.coef
+        with attacks.frozen_model(attack.model, attack.checkpoint):
+            for i in range(attack.num_steps):
+                coef.requires_grad = True
+                self.perturbation.coef = coef
+                with attack._autocast():
+                    output = attack.model(self.perturbation.apply(x_real), c_trg)
+                    loss = attack.loss_fn(output, gen_noattack)
+                grad = attacks.input_grad(loss, coef, attack.scaler)
+
+                coef = coef.detach().add_(grad.sign_(), alpha=8 * attack.a)
+                # No coefficient alone needs to go past the epsilon ball
+                attacks.clip_tensor_(coef, -8 * attack.epsilon, 8 * attack.epsilon)
+        self.perturbation.coef = coef
+
+
+def load_model_weights(model, path):
+    pretrained_dict = torch.load(path, map_location=lambda storage, loc: storage)
+    pretrained_dict = {k: v for k, v in pretrained_dict.items() if 'preprocessing' not in k}
+    model.load_state_dict(pretrained_dict, strict=False)
+
+
+def worker(rank, args, args_attack):
+    world_size = args.workers
+    if world_size > 1:
+        dist.init_process_group('gloo', init_method='tcp://127.0.0.1:{}'.format(args.port),
+                                rank=rank, world_size=world_size)
+        # Share the cores between the workers
+        torch.set_num_threads(max(1, os.cpu_count() // world_size))
+    np.random.seed(rank)
+
+    device = torch.device('cpu')
+    config = args_attack.stargan
+    G = Generator(config.g_conv_dim, config.c_dim, config.g_repeat_num)
+    load_model_weights(G, join(config.model_save_dir, '{}-G.ckpt'.format(args.resume_iters)))
+    G.to(device)
+
+    settings = args_attack.global_settings
+    dataset = CelebA(settings.data_path, settings.attr_path, settings.img_size, 'train',
+                     config.selected_attrs, config.selected_attrs)
+    attack = attacks.LinfPGDAttack.from_config(args_attack.attacks, model=G, device=device)
+
+    os.makedirs(settings.save_model_dir, exist_ok=True)
+    options = dict(checkpoint_every=args.checkpoint_every, c_dim=config.c_dim,
+                   selected_attrs=config.selected_attrs, rank=rank, world_size=world_size)
+    if args.compact:
+        trainer = CompactUniversalTrainer(attack, dataset, settings.batch_size,
+                                          join(settings.save_model_dir, 'universal_dct_checkpoint.pt'),
+                                          grid=args.grid, coefficients=args.coefficients, **options)
+    else:
+        trainer = UniversalTrainer(attack, dataset, settings.batch_size,
+                                   join(settings.save_model_dir, 'universal_checkpoint.pt'), **options)
+    up = trainer.train()
+
+    if rank == 0 and args.compact:
+        # The dense expansion keeps working with every loader of universal_perturbation_path
+        compact_path = os.path.splitext(settings.universal_perturbation_path)[0] + '_dct.pt'
+        torch.save(trainer.perturbation.state_dict(), compact_path)
+        print('Saved the compact universal perturbation into {}...'.format(compact_path))
+        with torch.no_grad():
+            up = trainer.perturbation.expand((settings.img_size, settings.img_size))
+    if rank == 0:
+        torch.save(up.cpu(), settings.universal_perturbation_path)
+        print('Saved the universal perturbation into {}...'.format(settings.universal_perturbation_path))
+    if world_size > 1:
+        dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    args, args_attack = parse()
+    if args.workers > 1:
+        mp.spawn(worker, args=(args, args_attack), nprocs=args.workers)
+    else:
+        worker(0, args, args_attack)